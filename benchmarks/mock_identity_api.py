@@ -0,0 +1,289 @@
+import sys
+import getopt
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ROLES = ["extadmin", "extseclead", "extcreator", "extsubmitter", "extreviewer", "extpolicyadmin",
+                 "extexecutive", "extmitigationapprover", "extsecurityinsights", "extelearn", "apisubmitanyscan"]
+DETAIL_FIELDS = ["roles", "teams", "allowed_ip_addresses", "ip_restricted", "phone", "title",
+                 "custom_one", "custom_two", "custom_three", "custom_four", "custom_five"]
+DEFAULT_PAGE_SIZE = 50
+
+
+def print_help():
+    """Prints command line options and exits"""
+    print("""mock_identity_api.py [-p <port>] [-u <users>] [-t <teams>] [-l <latency>] [-e <error_rate>] [-r <throttle_rate>]
+        Serves a local stand-in for the users, teams and roles endpoints of the Veracode identity API.
+        The directory is seeded with <users> users named user<n>@example.com and <teams> teams named 'Team <n>'.
+        Every request waits <latency> seconds, <error_rate> of them fail with a 503 and <throttle_rate> with a 429.
+        GET /__stats returns the number of calls per endpoint.
+""")
+    sys.exit()
+
+
+class IdentityState:
+    """In-memory users, teams and roles of the mock organization"""
+    def __init__(self, user_count=0, team_count=0):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.users_by_name = {}
+        self.teams = {}
+        self.teams_by_name = {}
+        self.roles = [{"role_id": str(uuid.UUID(int=index+1)), "role_name": role_name, "role_description": role_name[3:].title()}
+                      for index, role_name in enumerate(DEFAULT_ROLES)]
+        self.calls = defaultdict(int)
+        for index in range(team_count):
+            self.add_team(f"Team {index}")
+        team_ids = list(self.teams)
+        for index in range(user_count):
+            user = self.add_user({"user_name": f"user{index}@example.com", "first_name": "First", "last_name": f"User{index}",
+                                  "email_address": f"user{index}@example.com", "roles": [{"role_name": "extsubmitter"}]})
+            if team_ids:
+                user["teams"] = [{"team_id": team_ids[index % len(team_ids)], "relationship": {"name": "MEMBER"}}]
+
+    def add_team(self, team_name):
+        team = {"team_id": str(uuid.uuid4()), "team_name": team_name}
+        self.teams[team["team_id"]] = team
+        self.teams_by_name[team_name.lower()] = team
+        return team
+
+    def add_user(self, content):
+        user = {"user_id": str(uuid.uuid4()), "active": True, "login_enabled": True, "roles": [], "teams": [],
+                "ip_restricted": False, "allowed_ip_addresses": []}
+        user.update(content)
+        self.users[user["user_id"]] = user
+        self.users_by_name[user["user_name"].lower()] = user
+        return user
+
+    def get_user_view(self, user, detailed):
+        view = dict(user)
+        if detailed:
+            view["roles"] = [self.get_role_view(role) for role in user.get("roles", [])]
+            view["teams"] = [dict(team, team_name=self.teams[team["team_id"]]["team_name"])
+                             for team in user.get("teams", []) if team["team_id"] in self.teams]
+        else:
+            for field_name in DETAIL_FIELDS:
+                view.pop(field_name, None)
+        return view
+
+    def get_role_view(self, role):
+        for known_role in self.roles:
+            if known_role["role_name"] == role["role_name"]:
+                return dict(known_role)
+        return dict(role)
+
+    def get_team_members(self, team_id):
+        return [{"user_id": user["user_id"], "user_name": user["user_name"], "relationship": team["relationship"]}
+                for user in self.users.values() for team in user.get("teams", []) if team["team_id"] == team_id]
+
+    def get_invalid_reference(self, content):
+        role_names = {role["role_name"] for role in self.roles}
+        for role in content.get("roles", []):
+            if role["role_name"] not in role_names:
+                return f"Role {role['role_name']} not found"
+        for team in content.get("teams", []):
+            if team["team_id"] not in self.teams:
+                return f"Team {team['team_id']} not found"
+        return None
+
+
+def get_page(items, query, list_name):
+    size = int(query.get("size", [DEFAULT_PAGE_SIZE])[0])
+    page = int(query.get("page", [0])[0])
+    total_pages = max(1, (len(items)+size-1) // size)
+    body = {"page": {"size": size, "total_elements": len(items), "total_pages": total_pages, "number": page}}
+    page_items = items[page*size:(page+1)*size]
+    if page_items:
+        body["_embedded"] = {list_name: page_items}
+    return body
+
+
+class IdentityRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+    latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+
+    def setup(self):
+        super().setup()
+        # answers are written in two parts, which would otherwise wait for the client's delayed ACK on kept-alive connections
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body=None, headers=None):
+        content = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def dispatch(self, method):
+        parsed_path = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed_path.query)
+        parts = [part for part in parsed_path.path.split("/") if part]
+        body = self.read_body() if method in ("POST", "PUT") else None
+        if parts == ["__stats"]:
+            with self.state.lock:
+                return self.send_json(200, {"calls": dict(self.state.calls)})
+        resource = parts[3] if len(parts) > 3 else ""
+        with self.state.lock:
+            self.state.calls[f"{method} {resource}{'/{id}' if len(parts) > 4 else ''}"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            return self.send_json(429, {"message": "Too many requests"}, {"Retry-After": "0"})
+        if self.error_rate and random.random() < self.error_rate:
+            return self.send_json(503, {"message": "Service unavailable"})
+        handler = getattr(self, f"handle_{resource}", None)
+        if parts[:3] != ["api", "authn", "v2"] or not handler:
+            return self.send_json(404, {"message": "Not found"})
+        with self.state.lock:
+            return handler(method, parts[4:], query, body)
+
+    def handle_users(self, method, path, query, body):
+        state = self.state
+        if method == "GET" and not path:
+            if "user_name" in query:
+                user = state.users_by_name.get(query["user_name"][0].lower())
+                users = [user] if user else []
+            else:
+                users = list(state.users.values())
+            is_inactive = query.get("inactive", ["false"])[0] == "true"
+            is_detailed = query.get("detailed", ["false"])[0] == "true"
+            users = [state.get_user_view(user, is_detailed) for user in users if user.get("active", True) != is_inactive]
+            return self.send_json(200, get_page(users, query, "users"))
+        if method == "GET" and path == ["self"]:
+            return self.send_json(200, {"user_id": "self", "user_name": "api-user"})
+        if method == "POST":
+            if body["user_name"].lower() in state.users_by_name:
+                return self.send_json(409, {"message": "User already exists"})
+            error_message = state.get_invalid_reference(body)
+            if error_message:
+                return self.send_json(400, {"message": error_message})
+            response = state.get_user_view(state.add_user(body), True)
+            if query.get("generate_api_creds", ["false"])[0] == "true":
+                response["api_credentials"] = {"api_id": uuid.uuid4().hex, "api_secret": uuid.uuid4().hex * 2}
+            return self.send_json(201, response)
+        user = state.users.get(path[0]) if path else None
+        if not user:
+            return self.send_json(404, {"message": "User not found"})
+        if method == "GET":
+            return self.send_json(200, state.get_user_view(user, True))
+        if method == "PUT":
+            error_message = state.get_invalid_reference(body)
+            if error_message:
+                return self.send_json(400, {"message": error_message})
+            user.update(body)
+            return self.send_json(200, state.get_user_view(user, True))
+        return self.send_json(405, {"message": "Method not allowed"})
+
+    def handle_teams(self, method, path, query, body):
+        state = self.state
+        if method == "GET" and not path:
+            if "team_name" in query:
+                team = state.teams_by_name.get(query["team_name"][0].lower())
+                teams = [team] if team else []
+            else:
+                teams = list(state.teams.values())
+            return self.send_json(200, get_page([dict(team) for team in teams], query, "teams"))
+        if method == "POST":
+            if body["team_name"].lower() in state.teams_by_name:
+                return self.send_json(409, {"message": "Team already exists"})
+            return self.send_json(201, dict(state.add_team(body["team_name"])))
+        team = state.teams.get(path[0]) if path else None
+        if not team:
+            return self.send_json(404, {"message": "Team not found"})
+        if method == "GET":
+            return self.send_json(200, dict(team, users=state.get_team_members(team["team_id"])))
+        if method == "PUT":
+            if "users" in body:
+                members = {}
+                for member in body["users"]:
+                    user = state.users_by_name.get(member["user_name"].lower())
+                    if not user:
+                        return self.send_json(400, {"message": f"User {member['user_name']} not found"})
+                    members[user["user_id"]] = member.get("relationship", {"name": "MEMBER"})
+                is_incremental = query.get("incremental", ["false"])[0] == "true"
+                for user in state.users.values():
+                    other_teams = [user_team for user_team in user.get("teams", []) if user_team["team_id"] != team["team_id"]]
+                    if user["user_id"] in members:
+                        user["teams"] = other_teams + [{"team_id": team["team_id"], "relationship": members[user["user_id"]]}]
+                    elif not is_incremental:
+                        user["teams"] = other_teams
+            return self.send_json(200, dict(team, users=state.get_team_members(team["team_id"])))
+        return self.send_json(405, {"message": "Method not allowed"})
+
+    def handle_roles(self, method, path, query, body):
+        if method == "GET":
+            return self.send_json(200, get_page([dict(role) for role in self.state.roles], query, "roles"))
+        return self.send_json(405, {"message": "Method not allowed"})
+
+
+def create_server(port=0, user_count=0, team_count=0, latency=0.0, error_rate=0.0, throttle_rate=0.0):
+    """Creates a mock identity API server listening on localhost, port 0 picks a free port"""
+    request_handler = type("ConfiguredIdentityRequestHandler", (IdentityRequestHandler,), {
+        "state": IdentityState(user_count, team_count), "latency": latency, "error_rate": error_rate, "throttle_rate": throttle_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", port), request_handler)
+    server.daemon_threads = True
+    return server
+
+def main(argv):
+    """Serves the mock identity API until interrupted"""
+    port = 8080
+    user_count = 0
+    team_count = 0
+    latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    opts, args = getopt.getopt(argv, "hp:u:t:l:e:r:", ["port=","users=","teams=","latency=","error_rate=","throttle_rate="])
+    for opt, arg in opts:
+        if opt == '-h':
+            print_help()
+        if opt in ('-p', '--port'):
+            port = int(arg)
+        if opt in ('-u', '--users'):
+            user_count = int(arg)
+        if opt in ('-t', '--teams'):
+            team_count = int(arg)
+        if opt in ('-l', '--latency'):
+            latency = float(arg)
+        if opt in ('-e', '--error_rate'):
+            error_rate = float(arg)
+        if opt in ('-r', '--throttle_rate'):
+            throttle_rate = float(arg)
+    server = create_server(port, user_count, team_count, latency, error_rate, throttle_rate)
+    print(f"Listening on http://127.0.0.1:{server.server_address[1]}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
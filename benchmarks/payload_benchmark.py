@@ -0,0 +1,155 @@
+import sys
+import getopt
+import json
+import timeit
+from script_loader import load_script
+
+bulk_user_management = load_script()
+
+NONE = bulk_user_management.NONE
+TEAM_ADMIN_RELATIONSHIP = bulk_user_management.TEAM_ADMIN_RELATIONSHIP
+TEAM_MEMBER_RELATIONSHIP = bulk_user_management.TEAM_MEMBER_RELATIONSHIP
+
+
+def print_help():
+    """Prints command line options and exits"""
+    print("""payload_benchmark.py [-n <iterations>]
+        Compares building user request bodies as dictionaries with the previous approach of concatenating
+        JSON fragments, parsing them with json.loads and serializing them again.
+""")
+    sys.exit()
+
+# The previous payload builder, kept here as the baseline of the comparison
+
+def legacy_add_field_if_not_blank_or_none(current_content, field_name, field_value, is_boolean=False):
+    if not field_value:
+        return current_content
+    if field_value == NONE:
+        field_value = ''
+    if field_name:
+        return current_content + f''',
+            "{field_name}": {'' if is_boolean else '"'}{field_value}{'' if is_boolean else '"'}'''
+    else:
+        return current_content + f''',
+            {field_value}'''
+
+def legacy_list_roles(roles):
+    if not roles:
+        return ""
+    inner_role_list = ""
+    for role_name in roles.split(","):
+        inner_role_list = inner_role_list + (""",
+            """ if inner_role_list else "") + f'{{ "role_name": "{role_name.strip()}" }}'
+    return f'''
+            "roles": [
+                {inner_role_list}
+            ]'''
+
+def legacy_list_teams(api_base, teams, teams_managed, verbose):
+    if not teams and not teams_managed:
+        return ""
+    if teams == NONE:
+        return '"teams": []'
+    all_teams_json = bulk_user_management.get_all_teams_json(api_base, bulk_user_management.split_team_names(teams),
+                                                             bulk_user_management.split_team_names(teams_managed), verbose)
+    inner_team_list = ""
+    for team in all_teams_json.values():
+        team_value = f'''{{
+            "team_id": "{team["team_id"]}",
+            "relationship": {{
+                "name": "{team["relationship"]}"
+            }}
+        }}'''
+        inner_team_list = inner_team_list + (""",
+        """ if inner_team_list else "") + team_value
+    return f'''
+            "teams": [
+                {inner_team_list}
+            ]''' if inner_team_list else ""
+
+def legacy_list_allowed_ip_addresses(allowed_ip_addresses):
+    if not allowed_ip_addresses:
+        return ""
+    if allowed_ip_addresses == NONE:
+        return '"ip_restricted": false, "allowed_ip_addresses": []'
+    inner_ip_addresses_list = ""
+    for ip_address in allowed_ip_addresses.split(","):
+        inner_ip_addresses_list = inner_ip_addresses_list + (""",
+            """ if inner_ip_addresses_list else "") + f'"{ip_address.strip()}"'
+    return f'''
+            "ip_restricted": true, "allowed_ip_addresses": [
+                {inner_ip_addresses_list}
+            ]'''
+
+def legacy_build_user_payload(api_base, user, is_new_user, verbose):
+    content = f'''"user_name": "{user.username}"'''
+    if is_new_user and user.is_service_account:
+        content = content + ''',"permissions":[
+      {
+         "permission_name":"apiUser"
+      }
+   ]'''
+    content = legacy_add_field_if_not_blank_or_none(content, "active", None if user.is_active == None else str(user.is_active).lower(), True)
+    content = legacy_add_field_if_not_blank_or_none(content, "first_name", user.first_name)
+    content = legacy_add_field_if_not_blank_or_none(content, "last_name", user.last_name)
+    content = legacy_add_field_if_not_blank_or_none(content, "email_address", user.email)
+    content = legacy_add_field_if_not_blank_or_none(content, "phone", user.phone)
+    content = legacy_add_field_if_not_blank_or_none(content, "title", user.position)
+    content = legacy_add_field_if_not_blank_or_none(content, None, legacy_list_allowed_ip_addresses(user.restrict_login_ips))
+    content = legacy_add_field_if_not_blank_or_none(content, "login_enabled", None if user.is_login_enabled == None else str(user.is_login_enabled).lower(), True)
+    content = legacy_add_field_if_not_blank_or_none(content, "custom_one", user.custom_1)
+    content = legacy_add_field_if_not_blank_or_none(content, "custom_two", user.custom_2)
+    content = legacy_add_field_if_not_blank_or_none(content, "custom_three", user.custom_3)
+    content = legacy_add_field_if_not_blank_or_none(content, "custom_four", user.custom_4)
+    content = legacy_add_field_if_not_blank_or_none(content, "custom_five", user.custom_5)
+    content = legacy_add_field_if_not_blank_or_none(content, None, legacy_list_roles(user.roles))
+    content = legacy_add_field_if_not_blank_or_none(content, None, legacy_list_teams(api_base, user.teams, user.teams_managed, verbose))
+    request_content=f'''{{
+            {content}
+        }}'''
+    return json.loads(request_content)
+
+def get_sample_users(team_count, ip_count):
+    team_names = [f"Team {index}" for index in range(team_count)]
+    for index, team_name in enumerate(team_names):
+        bulk_user_management.teams_cache[bulk_user_management.team_key(team_name)] = f"00000000-0000-0000-0000-{index:012d}"
+    return {
+        "typical row": bulk_user_management.UserRow(
+            False, True, "jane.doe@example.com", "Jane", "Doe", "jane.doe@example.com", "555-0100", "Developer",
+            None, True, "Cost center 12", None, None, None, None, "Team 1, Team 2", "extsubmitter, extcreator", "Team 3"),
+        f"{team_count} teams, {ip_count} IPs": bulk_user_management.UserRow(
+            False, True, "john.doe@example.com", "John", "Doe", "john.doe@example.com", "555-0101", "Security Lead",
+            ", ".join(f"10.{index // 256}.{index % 256}.0/24" for index in range(ip_count)), True,
+            "Cost center 12", "Building 4", "Floor 2", "Desk 7", "Remote", ", ".join(team_names[::2]),
+            "extseclead, extsubmitter, extcreator, extreviewer", ", ".join(team_names[1::2])),
+    }
+
+def run_benchmark(iterations):
+    api_base = "https://api.veracode.com/"
+    for name, user in get_sample_users(200, 100).items():
+        legacy_payload = legacy_build_user_payload(api_base, user, False, False)
+        payload = bulk_user_management.build_user_payload(api_base, user, False, False)
+        if legacy_payload != payload:
+            print(f"ERROR: payloads differ for {name}")
+            sys.exit(1)
+        # both bodies are serialized again by requests when they are sent
+        legacy_time = timeit.timeit(lambda: json.dumps(legacy_build_user_payload(api_base, user, False, False)), number=iterations)
+        native_time = timeit.timeit(lambda: json.dumps(bulk_user_management.build_user_payload(api_base, user, False, False)), number=iterations)
+        print(f"{name}:")
+        print(f"    string concatenation: {legacy_time / iterations * 1e6:10.1f} us per payload")
+        print(f"    native structures:    {native_time / iterations * 1e6:10.1f} us per payload ({legacy_time / native_time:.1f}x faster)")
+
+def main(argv):
+    """Benchmarks building user request bodies"""
+    iterations = 2000
+    opts, args = getopt.getopt(argv, "hn:", ["iterations="])
+    for opt, arg in opts:
+        if opt == '-h':
+            print_help()
+        if opt in ('-n', '--iterations'):
+            iterations = int(arg)
+    run_benchmark(iterations)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
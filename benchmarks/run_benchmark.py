@@ -0,0 +1,193 @@
+import sys
+import os
+import getopt
+import json
+import time
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from contextlib import redirect_stdout
+import openpyxl
+from script_loader import load_script
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is then not reported
+    resource = None
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+MOCK_API_PATH = os.path.join(BENCHMARKS_PATH, "mock_identity_api.py")
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+TEAM_COUNT = 50
+NEW_USER_RATE = 10
+NEW_TEAM_RATE = 100
+
+
+def print_help():
+    """Prints command line options and exits"""
+    print("""run_benchmark.py [-s <sizes>] [-w <workers>] [-l <latency>] [-e <error_rate>] [-r <throttle_rate>] [-p] [-o <report_file>]
+        Runs modify_all_users against a local mock of the Veracode identity API, once for every comma separated row count
+        in <sizes> (defaults to 1000,10000,100000), and reports rows per second, API calls per row by endpoint,
+        p50/p99 request latency and peak memory.
+        One in every 10 rows creates a user and one in every 100 rows references a team that does not exist yet.
+        -w sets the number of workers (defaults to 8) and -p prefetches the user directory.
+        -l sets the latency of the mock API in seconds (defaults to 0.01), -e and -r the share of requests answered
+            with a 503 or a 429.
+        -o also writes the results to <report_file> as JSON.
+""")
+    sys.exit()
+
+def generate_workbook(file_name, row_count, directory_size):
+    """Writes a workbook in the template layout where most rows update existing users of the mock directory"""
+    bulk_user_management = load_script()
+    excel_file = openpyxl.Workbook(write_only=True)
+    excel_sheet = excel_file.create_sheet("Users")
+    for header_row in range(1, bulk_user_management.FIRST_ROW):
+        excel_sheet.append([f"Header {header_row}"] * bulk_user_management.API_SECRET_COLUMN)
+    for index in range(row_count):
+        values = [None] * bulk_user_management.LAST_COLUMN
+        is_new_user = index % NEW_USER_RATE == 0
+        username = f"new{index}@example.com" if is_new_user else f"user{index % directory_size}@example.com"
+        teams = f"Team {index % TEAM_COUNT}, Team {(index+1) % TEAM_COUNT}"
+        if index % NEW_TEAM_RATE == 0:
+            teams += f", Benchmark Team {index // NEW_TEAM_RATE}"
+        values[bulk_user_management.USERNAME_COLUMN-1] = username
+        values[bulk_user_management.FIRST_NAME_COLUMN-1] = "Benchmark"
+        values[bulk_user_management.LAST_NAME_COLUMN-1] = f"User {index}"
+        values[bulk_user_management.EMAIL_COLUMN-1] = username
+        values[bulk_user_management.TEAMS_COLUMN-1] = teams
+        values[bulk_user_management.ROLES_COLUMN-1] = "extsubmitter, extcreator"
+        values[bulk_user_management.TEAMS_MANAGED_COLUMN-1] = f"Team {index % TEAM_COUNT}" if index % 5 == 0 else None
+        excel_sheet.append(values)
+    excel_file.save(file_name)
+
+def start_mock_api(directory_size, latency, error_rate, throttle_rate):
+    process = subprocess.Popen([sys.executable, MOCK_API_PATH, "-p", "0", "-u", str(directory_size), "-t", str(TEAM_COUNT),
+                                "-l", str(latency), "-e", str(error_rate), "-r", str(throttle_rate)],
+                               stdout=subprocess.PIPE, text=True)
+    api_base = process.stdout.readline().strip().split(" ")[-1]
+    return process, api_base
+
+def get_endpoint(request):
+    parts = urllib.request.urlparse(request.url).path.strip("/").split("/")[3:]
+    return f"{request.method} {parts[0]}{'/{id}' if len(parts) > 1 else ''}" if parts else f"{request.method} /"
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values)-1, int(round(percentile * (len(sorted_values)-1))))]
+
+def get_peak_memory_mb():
+    if not resource:
+        return None
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak_memory / (1024 * 1024) if sys.platform == "darwin" else peak_memory / 1024
+
+def run_single(api_base, file_name, row_count, workers, prefetch_users):
+    """Processes one workbook in this process and prints its measurements as JSON"""
+    bulk_user_management = load_script()
+    bulk_user_management.workers = workers
+    latencies = {}
+    latencies_lock = threading.Lock()
+
+    def record_response(response, *args, **kwargs):
+        with latencies_lock:
+            latencies.setdefault(get_endpoint(response.request), []).append(response.elapsed.total_seconds())
+
+    bulk_user_management.get_session().hooks["response"].append(record_response)
+    start_time = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        bulk_user_management.modify_all_users(api_base, file_name, True, False, prefetch_users, False, False, False, False, False, False)
+    elapsed_time = time.perf_counter() - start_time
+    all_latencies = sorted(latency for endpoint_latencies in latencies.values() for latency in endpoint_latencies)
+    print(json.dumps({
+        "rows": row_count,
+        "seconds": elapsed_time,
+        "rows_per_second": row_count / elapsed_time,
+        "calls_per_row": {endpoint: len(endpoint_latencies) / row_count for endpoint, endpoint_latencies in sorted(latencies.items())},
+        "p50_latency_ms": get_percentile(all_latencies, 0.5) * 1000,
+        "p99_latency_ms": get_percentile(all_latencies, 0.99) * 1000,
+        "peak_memory_mb": get_peak_memory_mb()
+    }))
+
+def run_benchmark(sizes, workers, latency, error_rate, throttle_rate, prefetch_users):
+    results = []
+    environment = dict(os.environ, VERACODE_API_KEY_ID="0" * 32, VERACODE_API_KEY_SECRET="0" * 128)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        for row_count in sizes:
+            file_name = os.path.join(temporary_directory, f"benchmark-{row_count}.xlsx")
+            print(f"Generating {row_count} rows")
+            generate_workbook(file_name, row_count, row_count)
+            mock_api, api_base = start_mock_api(row_count, latency, error_rate, throttle_rate)
+            try:
+                print(f"Processing {row_count} rows with {workers} workers")
+                # every size runs in its own process so that its peak memory is measured on its own
+                output = subprocess.run([sys.executable, __file__, "--run", file_name, "--api_base", api_base, "-s", str(row_count),
+                                         "-w", str(workers)] + (["-p"] if prefetch_users else []),
+                                        env=environment, check=True, capture_output=True, text=True).stdout
+                results.append(json.loads(output.strip().splitlines()[-1]))
+            finally:
+                mock_api.terminate()
+                mock_api.wait()
+    return results
+
+def print_results(results):
+    print()
+    print(f"{'rows':>8} {'rows/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8}  API calls per row")
+    for result in results:
+        calls_per_row = ", ".join(f"{endpoint}: {calls:.2f}" for endpoint, calls in result["calls_per_row"].items())
+        peak_memory = f"{result['peak_memory_mb']:8.1f}" if result["peak_memory_mb"] is not None else f"{'n/a':>8}"
+        print(f"{result['rows']:>8} {result['rows_per_second']:>9.1f} {result['p50_latency_ms']:>8.1f} {result['p99_latency_ms']:>8.1f} "
+              f"{peak_memory}  {calls_per_row}")
+
+def main(argv):
+    """Benchmarks modify_all_users against a local mock of the identity API"""
+    sizes = DEFAULT_SIZES
+    workers = 8
+    latency = 0.01
+    error_rate = 0.0
+    throttle_rate = 0.0
+    prefetch_users = False
+    report_file = None
+    run_file = None
+    api_base = None
+    opts, args = getopt.getopt(argv, "hs:w:l:e:r:po:", ["sizes=","workers=","latency=","error_rate=","throttle_rate=","prefetch",
+                                                        "report=","run=","api_base="])
+    for opt, arg in opts:
+        if opt == '-h':
+            print_help()
+        if opt in ('-s', '--sizes'):
+            sizes = [int(size) for size in arg.split(",")]
+        if opt in ('-w', '--workers'):
+            workers = int(arg)
+        if opt in ('-l', '--latency'):
+            latency = float(arg)
+        if opt in ('-e', '--error_rate'):
+            error_rate = float(arg)
+        if opt in ('-r', '--throttle_rate'):
+            throttle_rate = float(arg)
+        if opt in ('-p', '--prefetch'):
+            prefetch_users = True
+        if opt in ('-o', '--report'):
+            report_file = arg
+        if opt == '--run':
+            run_file = arg
+        if opt == '--api_base':
+            api_base = arg
+
+    if run_file:
+        run_single(api_base, run_file, sizes[0], workers, prefetch_users)
+        return
+    results = run_benchmark(sizes, workers, latency, error_rate, throttle_rate, prefetch_users)
+    print_results(results)
+    if report_file:
+        with open(report_file, "w") as report:
+            json.dump(results, report, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
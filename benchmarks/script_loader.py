@@ -0,0 +1,13 @@
+import os
+import importlib.util
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bulk-user-management.py")
+
+
+def load_script():
+    """Returns a new instance of bulk-user-management.py as a module.
+    The script's file name is not a valid module name, so it is loaded from its path"""
+    spec = importlib.util.spec_from_file_location("bulk_user_management", SCRIPT_PATH)
+    bulk_user_management = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bulk_user_management)
+    return bulk_user_management
@@ -1,14 +1,31 @@
 import sys
+import os
+import csv
+import re
 import requests
+from requests.adapters import HTTPAdapter
 import getopt
+import glob
 import json
+import configparser
+import ipaddress
 import urllib.parse
 from veracode_api_signing.plugin_requests import RequestsAuthPluginVeracodeHMAC
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from copy import copy
 import time
+import random
+import threading
+import sqlite3
+import hashlib
+from email.utils import parsedate_to_datetime
 import xml.etree.ElementTree as ET  # for parsing XML
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from veracode_api_signing.credentials import get_credentials
+from veracode_api_signing.credentials import get_credentials, ENV_API_KEY_NAME, ENV_API_SECRET_KEY_NAME
 
 
 class NoExactMatchFoundException(Exception):
@@ -35,6 +52,313 @@ class UnableToCreateTeamException(Exception):
     def get_message(self):
         return self.message
 
+class InvalidFieldValueException(Exception):
+    message=""
+    def __init__(self, message_to_set):
+        self.message = message_to_set
+
+    def get_message(self):
+        return self.message
+
+class TextResultWriter:
+    """Streams the result of every row of a CSV or JSON Lines file to a results file of the same format.
+    The results are written to a temporary file that replaces the previous results when closed, keeping the previous
+    results of the rows that were not written again"""
+    def __init__(self, file_name, previous_results):
+        self.file_name = file_name
+        self.previous_results = previous_results
+        self.written_rows = set()
+        self.is_csv = is_csv_file(file_name)
+        self.temporary_file_name = f"{file_name}.tmp"
+        # the results hold generated API secrets, so only the current user may read them
+        self.file = os.fdopen(os.open(self.temporary_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", newline="", encoding="utf-8")
+        if self.is_csv:
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(RESULT_FIELDS)
+
+    def write(self, row, username, result):
+        self.written_rows.add(row)
+        values = [row, username, *result]
+        if self.is_csv:
+            self.writer.writerow(values)
+        else:
+            self.file.write(json.dumps(dict(zip(RESULT_FIELDS, values)), default=str) + "\n")
+
+    def close(self):
+        # an interrupted run has not reached every row, their previous results are kept
+        for row, entry in self.previous_results.items():
+            if row not in self.written_rows:
+                self.write(row, entry["username"], (entry["status"], entry["api_id"], entry["api_secret"]))
+        self.file.close()
+        os.replace(self.temporary_file_name, self.file_name)
+
+class ProgressJournal:
+    """Append-only record of processed rows, written to disk in batches so an interrupted run loses at most one batch.
+    The file is only created when the first batch is written, so a run that fails before processing any row leaves none"""
+    def __init__(self, journal_name):
+        self.journal_name = journal_name
+        self.lock = threading.Lock()
+        self.pending_lines = []
+        self.last_flush = time.monotonic()
+        self.file = None
+
+    def open_file(self):
+        # the journal holds generated API secrets, so only the current user may read it
+        self.file = os.fdopen(os.open(self.journal_name, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "a", encoding="utf-8")
+        if not ends_with_newline(self.journal_name):
+            # a run killed while writing leaves an incomplete last line, the next records must not be appended to it
+            self.file.write("\n")
+
+    def append(self, row, username, result):
+        status, api_id, api_secret = result
+        line = json.dumps({"row": row, "username": username, "status": status, "api_id": api_id, "api_secret": api_secret}, default=str)
+        with self.lock:
+            self.pending_lines.append(line)
+            if len(self.pending_lines) >= JOURNAL_BATCH_SIZE or time.monotonic() - self.last_flush >= JOURNAL_FLUSH_INTERVAL:
+                self.flush_pending_lines()
+
+    def flush_pending_lines(self):
+        if self.pending_lines:
+            if not self.file:
+                self.open_file()
+            self.file.write("\n".join(self.pending_lines) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending_lines = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.flush_pending_lines()
+            if self.file:
+                self.file.close()
+
+class ApiProfile:
+    """One set of API credentials with its own connection pool and throttling state.
+    Without credentials, the default credentials of the Veracode signing library are used"""
+    def __init__(self, name, api_key_id=None, api_key_secret=None):
+        self.name = name
+        self.api_key_id = api_key_id
+        self.api_key_secret = api_key_secret
+        self.lock = threading.Lock()
+        self.session = None
+        self.throttled_until = 0.0
+        self.request_count = 0
+        self.throttled_count = 0
+
+    def get_session(self):
+        """Returns the HTTP session of the profile, creating its connection pool on first use"""
+        with self.lock:
+            if self.session is None:
+                connections = pool_size or max(workers, prefetch_workers)
+                new_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+                new_session.mount("https://", adapter)
+                new_session.mount("http://", adapter)
+                new_session.auth = RequestsAuthPluginVeracodeHMAC(self.api_key_id, self.api_key_secret)
+                new_session.headers.update(json_headers)
+                self.session = new_session
+            return self.session
+
+    def record_request(self):
+        with self.lock:
+            self.request_count += 1
+
+    def record_throttle(self, delay):
+        with self.lock:
+            self.throttled_count += 1
+            self.throttled_until = max(self.throttled_until, time.monotonic() + delay)
+
+    def get_wait(self):
+        return max(0.0, self.throttled_until - time.monotonic())
+
+class PersistentIdCache:
+    """User and team ids saved to a SQLite file between runs, scoped to an API base and API key.
+    Ids read from the file are tracked until they are invalidated, so a stale id can be looked up again"""
+    def __init__(self, file_name, scope, ttl):
+        self.lock = threading.Lock()
+        self.scope = scope
+        self.pending_writes = 0
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ids (scope TEXT, kind TEXT, name TEXT, id TEXT, updated_at REAL, "
+                                "PRIMARY KEY (scope, kind, name))")
+        self.connection.execute("DELETE FROM ids WHERE updated_at < ?", (time.time() - ttl,))
+        self.connection.commit()
+        self.ids = {CACHE_USERS: {}, CACHE_TEAMS: {}}
+        for kind, name, cached_id in self.connection.execute("SELECT kind, name, id FROM ids WHERE scope = ?", (scope,)):
+            if kind in self.ids:
+                self.ids[kind][name] = cached_id
+        self.unverified_ids = {kind: set(ids) for kind, ids in self.ids.items()}
+        self.invalidated_ids = {kind: set() for kind in self.ids}
+
+    def get(self, kind, name):
+        with self.lock:
+            return self.ids[kind].get(name)
+
+    def put(self, kind, name, cached_id):
+        with self.lock:
+            if self.ids[kind].get(name) == cached_id:
+                self.unverified_ids[kind].discard(name)
+                return
+            self.ids[kind][name] = cached_id
+            self.unverified_ids[kind].discard(name)
+            self.connection.execute("INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?, ?)", (self.scope, kind, name, cached_id, time.time()))
+            self.pending_writes += 1
+            if self.pending_writes >= CACHE_COMMIT_SIZE:
+                self.connection.commit()
+                self.pending_writes = 0
+
+    def invalidate(self, kind, name):
+        """Forgets an id read from the file, returning False if it was not read from the file"""
+        with self.lock:
+            if name not in self.unverified_ids[kind]:
+                return False
+            self.unverified_ids[kind].discard(name)
+            self.invalidated_ids[kind].add(name)
+            self.ids[kind].pop(name, None)
+            self.connection.execute("DELETE FROM ids WHERE scope = ? AND kind = ? AND name = ?", (self.scope, kind, name))
+            self.pending_writes += 1
+            return True
+
+    def was_invalidated(self, kind, name):
+        """Returns whether an id read from the file was found stale during this run"""
+        with self.lock:
+            return name in self.invalidated_ids[kind]
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+class LatencyHistogram:
+    """Count and sum of observed durations, bucketed by LATENCY_BUCKETS"""
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for index, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def get_cumulative_buckets(self):
+        cumulative_buckets = []
+        total = 0
+        for upper_bound, bucket_count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            total += bucket_count
+            cumulative_buckets.append((str(upper_bound), total))
+        cumulative_buckets.append(("+Inf", self.count))
+        return cumulative_buckets
+
+    def as_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": dict(self.get_cumulative_buckets())}
+
+class RunMetrics:
+    """Timings of every API call and of every phase of row processing, shared by all workers"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.endpoints = {}
+        self.phases = {}
+        self.rows = {}
+
+    def record_call(self, method, path, status, seconds, retries, retry_wait, bytes_sent, bytes_received):
+        key = (method, get_endpoint_template(path))
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            if not endpoint:
+                endpoint = self.endpoints[key] = {"statuses": {}, "retries": 0, "retry_wait": 0.0, "bytes_sent": 0,
+                                                  "bytes_received": 0, "latency": LatencyHistogram()}
+            endpoint["statuses"][status] = endpoint["statuses"].get(status, 0) + 1
+            endpoint["retries"] += retries
+            endpoint["retry_wait"] += retry_wait
+            endpoint["bytes_sent"] += bytes_sent
+            endpoint["bytes_received"] += bytes_received
+            endpoint["latency"].observe(seconds)
+
+    def record_phase(self, phase, seconds):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = LatencyHistogram()
+            self.phases[phase].observe(seconds)
+
+    @contextmanager
+    def timed_phase(self, phase):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - start_time)
+
+    def record_row(self, outcome):
+        with self.lock:
+            self.rows[outcome] = self.rows.get(outcome, 0) + 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "duration_seconds": round(time.perf_counter() - self.start_time, 6),
+                "rows": dict(self.rows),
+                "profiles": {str(profile.name or "default"): {"requests": profile.request_count, "throttled": profile.throttled_count}
+                             for profile in api_profiles},
+                "endpoints": {f"{method} {endpoint_template}": {
+                        "calls": endpoint["latency"].count,
+                        "statuses": {str(status): count for status, count in endpoint["statuses"].items()},
+                        "retries": endpoint["retries"],
+                        "retry_wait_seconds": round(endpoint["retry_wait"], 6),
+                        "bytes_sent": endpoint["bytes_sent"],
+                        "bytes_received": endpoint["bytes_received"],
+                        "latency_seconds": endpoint["latency"].as_dict()
+                    } for (method, endpoint_template), endpoint in sorted(self.endpoints.items())},
+                "phases": {phase: histogram.as_dict() for phase, histogram in sorted(self.phases.items())}
+            }
+
+    def as_prometheus_text(self):
+        report = self.as_dict()
+        lines = [
+            "# HELP bulk_user_management_run_duration_seconds Time since the run started",
+            "# TYPE bulk_user_management_run_duration_seconds gauge",
+            f"bulk_user_management_run_duration_seconds {report['duration_seconds']}",
+            "# HELP bulk_user_management_rows_total Rows by outcome",
+            "# TYPE bulk_user_management_rows_total counter"]
+        lines += [f'bulk_user_management_rows_total{{outcome="{outcome}"}} {count}' for outcome, count in sorted(report["rows"].items())]
+        for metric_name, field_name, metric_help in [
+                ("profile_requests_total", "requests", "API call attempts by credential profile"),
+                ("profile_throttled_total", "throttled", "Throttled API call attempts by credential profile")]:
+            lines += [f"# HELP bulk_user_management_{metric_name} {metric_help}", f"# TYPE bulk_user_management_{metric_name} counter"]
+            lines += [f'bulk_user_management_{metric_name}{{profile="{profile_name}"}} {profile[field_name]}'
+                      for profile_name, profile in report["profiles"].items()]
+        for metric_name, field_name, metric_help in [
+                ("api_retries_total", "retries", "Retried attempts of API calls"),
+                ("api_retry_wait_seconds_total", "retry_wait_seconds", "Time spent waiting before retrying API calls"),
+                ("api_request_bytes_total", "bytes_sent", "Bytes sent in API request bodies"),
+                ("api_response_bytes_total", "bytes_received", "Bytes received in API response bodies")]:
+            lines += [f"# HELP bulk_user_management_{metric_name} {metric_help}", f"# TYPE bulk_user_management_{metric_name} counter"]
+            for endpoint_name, endpoint in report["endpoints"].items():
+                method, endpoint_template = endpoint_name.split(" ", 1)
+                lines.append(f'bulk_user_management_{metric_name}{{method="{method}",endpoint="{endpoint_template}"}} {endpoint[field_name]}')
+        lines += ["# HELP bulk_user_management_api_requests_total API calls by final status code",
+                  "# TYPE bulk_user_management_api_requests_total counter"]
+        for endpoint_name, endpoint in report["endpoints"].items():
+            method, endpoint_template = endpoint_name.split(" ", 1)
+            for status, count in endpoint["statuses"].items():
+                lines.append(f'bulk_user_management_api_requests_total{{method="{method}",endpoint="{endpoint_template}",status="{status}"}} {count}')
+        lines += ["# HELP bulk_user_management_api_request_duration_seconds Duration of API calls, including retries",
+                  "# TYPE bulk_user_management_api_request_duration_seconds histogram"]
+        for endpoint_name, endpoint in report["endpoints"].items():
+            method, endpoint_template = endpoint_name.split(" ", 1)
+            lines += get_prometheus_histogram("bulk_user_management_api_request_duration_seconds",
+                                              f'method="{method}",endpoint="{endpoint_template}"', endpoint["latency_seconds"])
+        lines += ["# HELP bulk_user_management_row_phase_duration_seconds Duration of each phase of processing a row",
+                  "# TYPE bulk_user_management_row_phase_duration_seconds histogram"]
+        for phase, histogram in report["phases"].items():
+            lines += get_prometheus_histogram("bulk_user_management_row_phase_duration_seconds", f'phase="{phase}"', histogram)
+        return "\n".join(lines) + "\n"
+
 
 API_SERVICE_ACCOUNT_COLUMN = 1
 
@@ -65,32 +389,178 @@ LAST_COLUMN = TEAMS_MANAGED_COLUMN
 STATUS_COLUMN = LAST_COLUMN+1
 API_ID_COLUMN = STATUS_COLUMN+1
 API_SECRET_COLUMN = API_ID_COLUMN+1
+
+USER_COLUMNS = {
+    "is_service_account": API_SERVICE_ACCOUNT_COLUMN,
+    "is_active": ACTIVE_COLUMN,
+    "username": USERNAME_COLUMN,
+    "first_name": FIRST_NAME_COLUMN,
+    "last_name": LAST_NAME_COLUMN,
+    "email": EMAIL_COLUMN,
+    "phone": PHONE_COLUMN,
+    "position": POSITION_COLUMN,
+    "restrict_login_ips": RESTRICT_LOGIN_IPS_COLUMN,
+    "is_login_enabled": LOGIN_ENABLED_COLUMN,
+    "custom_1": CUSTOM_1_COLUMN,
+    "custom_2": CUSTOM_2_COLUMN,
+    "custom_3": CUSTOM_3_COLUMN,
+    "custom_4": CUSTOM_4_COLUMN,
+    "custom_5": CUSTOM_5_COLUMN,
+    "teams": TEAMS_COLUMN,
+    "roles": ROLES_COLUMN,
+    "teams_managed": TEAMS_MANAGED_COLUMN
+}
+UserRow = namedtuple("UserRow", USER_COLUMNS.keys())
+# a line of a text file that could not be read, with every field blank and the reason in error
+UnreadableUserRow = namedtuple("UnreadableUserRow", UserRow._fields + ("error",))
+# what the single pass over a file before anything is sent finds
+RowScan = namedtuple("RowScan", ["row_count", "row_errors", "duplicate_of", "team_names", "duplicate_row_numbers", "team_batch_rows"])
+
+# header names of text files that differ from the UserRow field names, as normalized by get_field_name
+HEADER_ALIASES = {
+    "api_service_account": "is_service_account",
+    "active": "is_active",
+    "user_name": "username",
+    "email_address": "email",
+    "title": "position",
+    "login_enabled": "is_login_enabled",
+    "teams_not_incremental": "teams",
+    "roles_not_incremental": "roles",
+    "teams_managed_not_incremental": "teams_managed"
+}
+BOOLEAN_FIELDS = ("is_service_account", "is_active", "is_login_enabled")
+# the true/false fields sent to the API, API Service Account is only read when a user is created
+CHECKED_BOOLEAN_FIELDS = ("is_active", "is_login_enabled")
+EMAIL_PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+# comma separated fields whose values are combined when duplicate rows are merged
+MERGED_LIST_FIELDS = ("restrict_login_ips", "teams", "roles", "teams_managed")
+# the only fields set on rows that can be applied through team updates
+TEAM_BATCH_FIELDS = ("username", "teams", "teams_managed")
+RESULT_FIELDS = ["row", "username", "status", "api_id", "api_secret"]
+RESULTS_SUFFIX = ".results"
 STATUS_SUCCESS = "success"
+STATUS_UNCHANGED = "unchanged"
+COMPLETED_STATUSES = (STATUS_SUCCESS, STATUS_UNCHANGED)
 TEAM_ADMIN_RELATIONSHIP = "ADMIN"
 TEAM_MEMBER_RELATIONSHIP = "MEMBER"
 NONE = "NONE"
+DEFAULT_SYNC_THRESHOLD_PERCENT = 10
+
+TEMPLATE_FILE_NAME = "Excel Template.xlsx"
+API_USER_PERMISSION = "apiUser"
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_BATCH_SIZE = 50
+JOURNAL_FLUSH_INTERVAL = 1
+
+# upper bounds in seconds of the latency histograms, as used by Prometheus clients
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_SUFFIX = ".prom"
+
+CACHE_USERS = "user"
+CACHE_TEAMS = "team"
+CACHE_COMMIT_SIZE = 500
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+ROW_OUTCOME_FAILED = "failed"
+ROW_OUTCOME_SKIPPED = "skipped"
 
 verify_ssl = True
 
 teams_cache = {}
+failed_teams = {}
+teams_lock = threading.Lock()
+team_locks = {}
+
+user_index = {}
+user_index_loaded = False
+team_index_loaded = False
+id_cache = None
+role_catalog = None
 
 json_headers = {
     "Content-Type": "application/json"
 }
 
-failed_attempts = 0
 max_attempts_per_request = 10
-sleep_time = 10
+# seconds to wait for a connection and for each read of a response, so a stalled call is retried instead of blocking a worker
+connect_timeout = 10
+read_timeout = 60
+backoff_base = 1
+backoff_max = 60
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+workers = 1
+
+api_profiles = [ApiProfile(None)]
+profiles_lock = threading.Lock()
+# the profile used by the row a worker thread is processing
+thread_state = threading.local()
+pool_size = 0
+
+metrics = RunMetrics()
+
+PAGE_SIZE = 500
+prefetch_workers = 8
 
 
 def print_help():
     """Prints command line options and exits"""
-    print("""bulk-user-management.py -f <excel_file_with_user_information> [-c] [-g] [-d]"
+    print("""bulk-user-management.py -f <excel_file_with_user_information> [-c] [-g] [-d] [-p] [-u] [-s] [-r] [-m] [-t] [-w <workers>]"
+       bulk-user-management.py -e <export_file>
         Reads all lines in <excel_file_with_user_information>, for each line, it will modify the user profile
+        <excel_file_with_user_information> can also be a .csv or .jsonl file, using the template's column order or header names.
+            Their results are written to <file_name>.results.csv or <file_name>.results.jsonl, and rows marked there as
+            'success' or 'unchanged' are skipped on later runs, keeping their generated API credentials.
         If a field is left empty, it will not be modified, to clear assigned teams, set the value to NONE (case sensitive). 
         If a team does not exist, it will be created.
+        Roles are checked against the organization's roles before anything is sent, ignoring case and extra spaces.
+            A role can be given by its name or its description, rows with unknown roles are marked as failed.
         To create new users, you can pass the -c flag.
         You can use the -g flag to generate API credentials for new API accounts.
+        You can use the -p flag to load every user in the organization once before processing the file,
+            instead of looking up each username individually.
+        You can use the -u flag to compare each row with the user's current settings and only send the fields that changed.
+            Rows that would not change anything are marked as 'unchanged'.
+        You can use the -s flag to write the results by streaming a copy of the workbook, keeping memory use flat for very
+            large files. Only the formatting of the header rows is kept.
+        You can use the -w flag to process up to <workers> rows at the same time. Rows for the same username
+            are always processed in order.
+        Before anything is sent, every row is checked for a blank username, malformed email or IP addresses, Active and
+            Login Enabled columns with a value other than true or false, and roles the organization does not have.
+            Invalid rows are marked with all their errors, and a row that repeats the previous row of the same username
+            gets that row's result.
+        You can use the -m flag to send a single request for all the rows of a username. Their teams, roles and IP addresses
+            are combined (a NONE discards the values on the rows above it) and the last non-blank value of any other field is used.
+            The result is written to every merged row.
+        You can use --pool_size to set how many connections are kept open to the API (defaults to one per worker)
+            and --max_attempts to set how many times a throttled or failed call is attempted (defaults to 10).
+            A call that gets no connection within --connect_timeout seconds (defaults to 10) or no response data within
+            --read_timeout seconds (defaults to 60) counts as failed.
+        You can use --report to write the number, status, latency, retries and size of the API calls and the time spent
+            in each phase of processing a row (parse, lookup, teams, write, journal and save) to <report_file>,
+            as a Prometheus textfile if it ends with .prom or as JSON otherwise.
+        You can use the -t flag to apply the rows of existing users that only set Teams and Teams Managed with one or two
+            requests per changed team, instead of one request per user. The user directory is loaded first to find each user's
+            current teams. Rows that set any other field are still sent per user.
+            Added members are sent in a request that only names them. A team that loses members is read first and sent
+            back with its remaining members. If its members cannot be read, nobody is removed and the rows that remove
+            users fail.
+        You can use --sync to deactivate, once every row has been processed, the active users of the organization that are
+            not on any row of the file, except the user of the API credentials. Add --dry_run to only list those users
+            without processing the file. Nothing is deactivated if they are more than --sync_threshold percent
+            of the active users (defaults to 10), or if any row cannot be read or has values but no username.
+        You can pass -f several times and use wildcards, such as -f "units/*.xlsx", to process several files in one run,
+            sharing the connections, team index and user directory. Add --all_sheets to process every sheet of each workbook
+            instead of only the active one. Each file and sheet gets its own results and progress journal.
+        You can use the -e flag instead of -f to write every user of the organization to <export_file>, in the layout of the
+            Excel template, as a starting point for a bulk edit. Team names come from a single load of the team index.
+        You can use --profiles to spread the rows across several comma separated profiles of ~/.veracode/credentials,
+            all for the same region, each with its own connection pool. Throttled calls are retried on the profile that
+            can be used the soonest.
+        You can use --cache to keep the ids of users and teams in the <cache_file> SQLite database between runs, skipping their
+            lookups on later runs with the same API credentials. Ids expire after --cache_ttl seconds (defaults to 86400)
+            and are looked up again if the API no longer finds them.
+        Progress is recorded in <excel_file_with_user_information>.journal while the script runs. If a run is interrupted,
+            use the -r flag to skip the rows recorded in the journal and write their results to the file.
 """)
     sys.exit()
 
@@ -100,23 +570,135 @@ def row_as_number(row):
 def request_encode(value_to_encode):
     return urllib.parse.quote(value_to_encode, safe='')
 
+def get_current_profile():
+    return getattr(thread_state, "profile", None) or api_profiles[0]
+
+def choose_profile():
+    """Returns the profile that can be used the soonest, preferring the least used one"""
+    with profiles_lock:
+        now = time.monotonic()
+        return min(api_profiles, key=lambda profile: (max(now, profile.throttled_until), profile.request_count))
+
+def get_session():
+    """Returns the HTTP session of the current profile"""
+    return get_current_profile().get_session()
+
+def get_profile_credentials(profile_name, auth_file=None):
+    """Reads the API credentials of a profile from the Veracode credentials file"""
+    auth_file = auth_file or os.path.join(os.path.expanduser("~"), ".veracode", "credentials")
+    config = configparser.ConfigParser()
+    config.read(auth_file)
+    try:
+        return config.get(profile_name, ENV_API_KEY_NAME), config.get(profile_name, ENV_API_SECRET_KEY_NAME)
+    except configparser.Error:
+        print(f"ERROR: no credentials found for profile '{profile_name}' in {auth_file}")
+        sys.exit(1)
+
+def load_api_profiles(profile_names):
+    """Replaces the default credentials with the given profiles, which must all be for the same region"""
+    global api_profiles
+    new_profiles = [ApiProfile(profile_name, *get_profile_credentials(profile_name)) for profile_name in profile_names]
+    if len({get_region(profile.api_key_id) for profile in new_profiles}) > 1:
+        print("ERROR: all profiles must be for the same region")
+        sys.exit(1)
+    api_profiles = new_profiles
+    print(f"Spreading rows across {len(api_profiles)} profiles: {', '.join(profile_names)}")
+
+def print_profile_usage():
+    if len(api_profiles) < 2:
+        return
+    for profile in api_profiles:
+        print(f"Profile {profile.name}: {profile.request_count} requests, {profile.throttled_count} throttled")
+
+def get_endpoint_template(path):
+    """Returns the path of an API call without its query and with ids replaced, such as 'api/authn/v2/users/{id}'"""
+    endpoint_path = urllib.parse.urlparse(path).path.strip("/")
+    return re.sub(r"(?<=/)[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}(?=/|$)", "{id}", endpoint_path)
+
+def get_prometheus_histogram(metric_name, labels, histogram):
+    lines = [f'{metric_name}_bucket{{{labels},le="{upper_bound}"}} {count}' for upper_bound, count in histogram["buckets"].items()]
+    lines.append(f"{metric_name}_sum{{{labels}}} {histogram['sum']}")
+    lines.append(f"{metric_name}_count{{{labels}}} {histogram['count']}")
+    return lines
+
+def write_report(report_name):
+    """Writes the metrics of the run as a Prometheus textfile if report_name ends with .prom, as JSON otherwise"""
+    with open(report_name, "w", encoding="utf-8") as report_file:
+        if report_name.lower().endswith(PROMETHEUS_SUFFIX):
+            report_file.write(metrics.as_prometheus_text())
+        else:
+            json.dump(metrics.as_dict(), report_file, indent=4)
+    print(f"Wrote run report to {report_name}")
+
+def get_retry_delay(attempt, retry_after):
+    if retry_after:
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+def api_request(method, path, verbose, body=None):
+    """Sends a request through the session of the current profile.
+    Throttled (429) calls and connections that time out before the request is sent are always retried,
+    throttled calls on the profile that can be used the soonest, other server errors and connection failures only for GET and PUT"""
+    is_idempotent = method in ("GET", "PUT")
+    attempt = 0
+    retry_wait = 0.0
+    start_time = time.perf_counter()
+    profile = get_current_profile()
+    while True:
+        profile.record_request()
+        try:
+            response = profile.get_session().request(method, path, json=body, verify=verify_ssl, timeout=(connect_timeout, read_timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if (not is_idempotent and not isinstance(e, requests.ConnectTimeout)) or attempt+1 >= max_attempts_per_request:
+                metrics.record_call(method, path, type(e).__name__, time.perf_counter() - start_time, attempt, retry_wait, 0, 0)
+                raise
+            delay = get_retry_delay(attempt, None)
+            print(f"ERROR: calling {path}: {e}, retrying in {delay:.1f}s")
+        else:
+            if (response.status_code not in RETRYABLE_STATUS_CODES or attempt+1 >= max_attempts_per_request
+                    or (not is_idempotent and response.status_code != 429)):
+                metrics.record_call(method, path, response.status_code, time.perf_counter() - start_time, attempt, retry_wait,
+                                    len(response.request.body or b""), len(response.content))
+                return response
+            delay = get_retry_delay(attempt, response.headers.get("Retry-After"))
+            if response.status_code == 429:
+                profile.record_throttle(delay)
+                if len(api_profiles) > 1:
+                    profile = choose_profile()
+                    delay = profile.get_wait()
+            if verbose or response.status_code != 429:
+                print(f"ERROR: calling {path}: code {response.status_code}, retrying in {delay:.1f}s")
+        attempt+=1
+        retry_wait += delay
+        time.sleep(delay)
+
+def get_response_body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
 def find_exact_match(list, to_find, field_name):
-    for index in range(len(list)):
-        if list[index][field_name].lower() == to_find.lower():
-            return list[index]
+    to_find_lower = to_find.lower()
+    for item in list:
+        if item[field_name].lower() == to_find_lower:
+            return item
     print(f"Unable to find a member of list with '{field_name}' equal to '{to_find}'")
     raise NoExactMatchFoundException(f"Unable to find a member of list with {field_name} equal to {to_find}")
 
 def get_item_from_api_call(api_base, api_to_call, item_to_find, list_name, field_to_check, field_to_get, is_exact_match, verbose, error_on_not_found=True):
-    global failed_attempts
-    global sleep_time
-    global max_attempts_per_request
     path = f"{api_base}{api_to_call}"
     if verbose:
         print(f"Calling: {path}")
 
-    response = requests.get(path, auth=RequestsAuthPluginVeracodeHMAC(), headers=json_headers, verify=verify_ssl)
-    data = response.json()
+    response = api_request("GET", path, verbose)
+    data = get_response_body(response)
 
     if response.status_code == 200:
         if verbose:
@@ -133,54 +715,147 @@ def get_item_from_api_call(api_base, api_to_call, item_to_find, list_name, field
         print(f"ERROR: trying to get {list_name} named {item_to_find}")
         print(f"ERROR: code: {response.status_code}")
         print(f"ERROR: value: {data}")
-        failed_attempts+=1
-        if (failed_attempts < max_attempts_per_request):
-            time.sleep(sleep_time)
-            return get_item_from_api_call(api_base, api_to_call, item_to_find, list_name, field_to_check, field_to_get, is_exact_match, verbose, error_on_not_found)
-        else:
-            error_message = f"ERROR: trying to get {list_name} named {item_to_find}"
-            print(error_message)
-            raise NoResultFoundException(error_message)
+        error_message = f"ERROR: trying to get {list_name} named {item_to_find}"
+        print(error_message)
+        raise NoResultFoundException(error_message)
+
+def get_page_from_api_call(api_base, api_to_call, page, list_name, verbose):
+    path = f"{api_base}{api_to_call}{'&' if '?' in api_to_call else '?'}page={page}&size={PAGE_SIZE}"
+    if verbose:
+        print(f"Calling: {path}")
+
+    response = api_request("GET", path, verbose)
+    data = get_response_body(response)
+    if response.status_code == 200:
+        items = data["_embedded"][list_name] if "_embedded" in data else []
+        total_pages = data["page"]["total_pages"] if "page" in data else 1
+        return items, total_pages
+    print(f"ERROR: trying to get page {page} of {list_name}")
+    print(f"ERROR: code: {response.status_code}")
+    print(f"ERROR: value: {data}")
+    error_message = f"ERROR: trying to get page {page} of {list_name}"
+    print(error_message)
+    raise NoResultFoundException(error_message)
+
+def iterate_pages_from_api_call(api_base, api_to_call, list_name, verbose):
+    """Yields the items of every page of a paged listing in order, fetching all pages after the first in parallel"""
+    items, total_pages = get_page_from_api_call(api_base, api_to_call, 0, list_name, verbose)
+    yield items
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=prefetch_workers) as executor:
+            yield from executor.map(lambda page: get_page_from_api_call(api_base, api_to_call, page, list_name, verbose)[0],
+                                    range(1, total_pages))
+
+def get_all_items_from_api_call(api_base, api_to_call, list_name, verbose):
+    """Returns every item of a paged listing"""
+    items = []
+    for page_items in iterate_pages_from_api_call(api_base, api_to_call, list_name, verbose):
+        items.extend(page_items)
+    return items
+
+def index_user(user):
+    key = user["user_name"].strip().lower()
+    user_index[key] = user
+    if id_cache:
+        id_cache.put(CACHE_USERS, key, user["user_id"])
+
+def get_cache_scope(api_base):
+    # the API key belongs to a single organization, only a hash of its id is saved
+    return f"{api_base}|{hashlib.sha256(get_api_key_id().encode()).hexdigest()}"
+
+def open_id_cache(file_name, ttl, api_base):
+    global id_cache
+    id_cache = PersistentIdCache(file_name, get_cache_scope(api_base), ttl)
+    print(f"Loaded {len(id_cache.ids[CACHE_USERS])} users and {len(id_cache.ids[CACHE_TEAMS])} teams from {file_name}")
+
+def close_id_cache():
+    global id_cache
+    if id_cache:
+        id_cache.close()
+        id_cache = None
+
+def invalidate_cached_ids(user):
+    """Forgets the ids of a row's user and teams that were read from the id cache, returning whether there were any,
+    including ids that another row already found stale"""
+    if not id_cache:
+        return False
+    username_key = str(user.username).strip().lower()
+    team_keys = [team_key(team_name) for team_name in split_team_names(user.teams) + split_team_names(user.teams_managed)]
+    if id_cache.invalidate(CACHE_USERS, username_key):
+        user_index.pop(username_key, None)
+    for key in team_keys:
+        if id_cache.invalidate(CACHE_TEAMS, key):
+            with teams_lock:
+                teams_cache.pop(key, None)
+    return id_cache.was_invalidated(CACHE_USERS, username_key) or any(id_cache.was_invalidated(CACHE_TEAMS, key) for key in team_keys)
+
+def load_user_directory(api_base, detailed, verbose):
+    """Loads every active and inactive user in the organization into user_index"""
+    global user_index_loaded
+    print("Loading user directory")
+    for api_to_call, is_active in [("api/authn/v2/users?deleted=false", True), ("api/authn/v2/users?deleted=false&inactive=true", False)]:
+        if detailed:
+            api_to_call += "&detailed=true"
+        for user in get_all_items_from_api_call(api_base, api_to_call, "users", verbose):
+            # the field may be left out of the listing, the listing the user is in says whether it is active
+            user["active"] = is_active
+            index_user(user)
+    user_index_loaded = True
+    print(f"Loaded {len(user_index)} users")
+
+def role_key(role_name):
+    return " ".join(str(role_name).split()).lower()
+
+def load_role_catalog(api_base, verbose):
+    """Loads every role of the organization into role_catalog, keyed by name and by description"""
+    global role_catalog
+    print("Loading role catalog")
+    try:
+        roles = get_all_items_from_api_call(api_base, "api/authn/v2/roles", "roles", verbose)
+    except NoResultFoundException:
+        print("Unable to load the role catalog, role names will not be checked before they are sent")
+        return
+    catalog = {}
+    for role in roles:
+        if role.get("role_description"):
+            catalog.setdefault(role_key(role["role_description"]), role["role_name"])
+    for role in roles:
+        catalog[role_key(role["role_name"])] = role["role_name"]
+    role_catalog = catalog
+    print(f"Loaded {len(roles)} roles")
+
+def split_role_names(roles):
+    return [role_name.strip() for role_name in str(roles).split(",") if role_name.strip()]
+
+def get_unknown_roles(roles):
+    """Returns the names in a ROLES cell that are not in the role catalog, or none if the catalog is not loaded"""
+    if is_blank(roles) or role_catalog is None:
+        return []
+    return [role_name for role_name in split_role_names(roles) if role_key(role_name) not in role_catalog]
+
+def get_role_list(roles):
+    role_names = split_role_names(roles)
+    if role_catalog is not None:
+        role_names = [role_catalog.get(role_key(role_name), role_name) for role_name in role_names]
+    return [{"role_name": role_name} for role_name in role_names]
 
-def list_roles(roles):
-    if not roles:
-        return ""
-    all_roles = roles.split(",")
-    inner_role_list = ""
-    for role_name in all_roles:
-        inner_role_list = inner_role_list + (""",
-            """ if inner_role_list else "") + f'{{ "role_name": "{role_name.strip()}" }}'
-    if inner_role_list:
-        return f'''
-            "roles": [
-                {inner_role_list}
-            ]'''
-    else:
-        return None
-    
 def create_team_for_name(api_base, team_name, verbose):
-    global failed_attempts
-    global sleep_time
-    global max_attempts_per_request
     path = f"{api_base}api/authn/v2/teams"
     if verbose:
         print(f"Calling: {path}")
 
-    request_content=f'''{{
-            "team_name": "{team_name}"
-        }}'''
+    request_body = {"team_name": team_name}
     if verbose:
-        print(request_content)
+        print(json.dumps(request_body, indent=4))
 
-    response = requests.post(path, auth=RequestsAuthPluginVeracodeHMAC(), headers=json_headers, json=json.loads(request_content), verify=verify_ssl)
+    response = api_request("POST", path, verbose, request_body)
 
+    body = get_response_body(response)
     if verbose:
         print(f"status code {response.status_code}")
-        body = response.json()
         if body:
             print(body)
 
-    body = response.json()
     if response.status_code == 201:
         print(f"Successfully created team: {team_name}.")
         return body["team_id"]
@@ -201,65 +876,107 @@ def get_team_id_from_name(api_base, team_name, verbose):
     else:
         return create_team_for_name(api_base, team_name, verbose)
     
+def team_key(team_name):
+    return team_name.strip().lower()
+
+def get_team_id(api_base, team_name, verbose):
+    """Returns the id of a team, looking it up or creating it at most once even when called from several workers"""
+    key = team_key(team_name)
+    with teams_lock:
+        if key in teams_cache:
+            return teams_cache[key]
+        team_lock = team_locks.setdefault(key, threading.Lock())
+    with team_lock:
+        with teams_lock:
+            if key in teams_cache:
+                return teams_cache[key]
+            if key in failed_teams:
+                raise UnableToCreateTeamException(failed_teams[key])
+        cached_team_id = id_cache.get(CACHE_TEAMS, key) if id_cache else None
+        if cached_team_id:
+            # not saved again, so the id can still be invalidated if the API no longer finds it
+            with teams_lock:
+                teams_cache[key] = cached_team_id
+            return cached_team_id
+        try:
+            team_id = get_team_id_from_name(api_base, team_name, verbose)
+        except UnableToCreateTeamException as e:
+            with teams_lock:
+                failed_teams[key] = e.get_message()
+            raise
+        cache_team_id(key, team_id)
+        return team_id
+
+def cache_team_id(key, team_id):
+    with teams_lock:
+        teams_cache[key] = team_id
+    if id_cache:
+        id_cache.put(CACHE_TEAMS, key, team_id)
+
+def load_team_index(api_base, verbose):
+    """Loads every team in the organization into teams_cache"""
+    global team_index_loaded
+    print("Loading team index")
+    for team in get_all_items_from_api_call(api_base, "api/authn/v2/teams?all_for_org=true", "teams", verbose):
+        cache_team_id(team_key(team["team_name"]), team["team_id"])
+    team_index_loaded = True
+    print(f"Loaded {len(teams_cache)} teams")
+
+def split_team_names(teams):
+    if not teams or teams == NONE:
+        return []
+    return [team_name.strip() for team_name in teams.split(",") if team_name.strip()]
+
+def prepare_teams(api_base, team_names, verbose):
+    """Resolves every referenced team against the team index, creating the missing ones once"""
+    if not team_names:
+        return
+    if id_cache:
+        for key in team_names:
+            if id_cache.get(CACHE_TEAMS, key):
+                teams_cache[key] = id_cache.get(CACHE_TEAMS, key)
+    if all(key in teams_cache for key in team_names):
+        print(f"Found all {len(team_names)} teams in the team index")
+        return
+    if not team_index_loaded:
+        load_team_index(api_base, verbose)
+    missing_teams = [team_name for key, team_name in team_names.items() if key not in teams_cache]
+    if missing_teams:
+        print(f"Creating {len(missing_teams)} missing teams")
+    for team_name in missing_teams:
+        try:
+            cache_team_id(team_key(team_name), create_team_for_name(api_base, team_name, verbose))
+        except UnableToCreateTeamException as e:
+            print(e.get_message())
+            failed_teams[team_key(team_name)] = e.get_message()
+
 def get_all_teams_json(api_base, all_teams, all_teams_managed, verbose):
-    global teams_cache
     all_teams_json = {}
-    for untrimmed_name in all_teams:
-        team_name = untrimmed_name.strip()
-        team_id = None
-        if team_name in teams_cache:
-            team_id = teams_cache[team_name]
-        else:
-            team_id = get_team_id_from_name(api_base, team_name, verbose)
-            teams_cache[team_name] = team_id
+    for team_name in all_teams:
+        team_id = get_team_id(api_base, team_name, verbose)
         if team_id:
             new_team = {}
             new_team["team_id"] = team_id
             new_team["relationship"] = TEAM_MEMBER_RELATIONSHIP
-            all_teams_json[team_name] = new_team
+            all_teams_json[team_key(team_name)] = new_team
 
-    for untrimmed_name in all_teams_managed:
-        team_name = untrimmed_name.strip()   
-        team_id = None
-        if team_name in all_teams_json:
-            all_teams_json[team_name]["relationship"] = TEAM_ADMIN_RELATIONSHIP
+    for team_name in all_teams_managed:
+        if team_key(team_name) in all_teams_json:
+            all_teams_json[team_key(team_name)]["relationship"] = TEAM_ADMIN_RELATIONSHIP
         else:
-            if team_name in teams_cache:
-                team_id = teams_cache[team_name]
-            else:
-                team_id = get_team_id_from_name(api_base, team_name, verbose)
-                teams_cache[team_name] = team_id
+            team_id = get_team_id(api_base, team_name, verbose)
             if team_id:
                 new_team = {}
                 new_team["team_id"] = team_id
                 new_team["relationship"] = TEAM_ADMIN_RELATIONSHIP
-                all_teams_json[team_name] = new_team
-    return all_teams_json if all_teams_json else None
+                all_teams_json[team_key(team_name)] = new_team
+    return all_teams_json
             
-def list_teams(api_base, teams, teamsManaged, verbose):
-    if not teams and not teamsManaged:
-        return ""
+def get_team_list(api_base, teams, teams_managed, verbose):
     if teams == NONE:
-        return '"teams": []'
-    all_teams_json = get_all_teams_json(api_base, teams.split(",") if teams else {}, teamsManaged.split(",") if teamsManaged else {}, verbose)
-
-    inner_team_list = ""
-    for team in all_teams_json.values():
-        team_value = f'''{{
-            "team_id": "{team["team_id"]}",
-            "relationship": {{
-                "name": "{team["relationship"]}"
-            }}
-        }}'''
-        inner_team_list = inner_team_list + (""",
-        """ if inner_team_list else "") + team_value
-    if inner_team_list:
-        return f'''
-            "teams": [
-                {inner_team_list}
-            ]'''
-    else:
-        return ""
+        return []
+    all_teams_json = get_all_teams_json(api_base, split_team_names(teams), split_team_names(teams_managed), verbose)
+    return [{"team_id": team["team_id"], "relationship": {"name": team["relationship"]}} for team in all_teams_json.values()]
 
 def get_error_node_value(body):
     inner_node = ET.XML(body)
@@ -269,61 +986,151 @@ def get_error_node_value(body):
         return ""
     
 def get_user_guid(api_base, username, verbose):
+    key = username.strip().lower()
+    if key in user_index:
+        return user_index[key]["user_id"]
+    if user_index_loaded:
+        return ""
+    cached_guid = id_cache.get(CACHE_USERS, key) if id_cache else None
+    if cached_guid:
+        user_index[key] = {"user_name": username.strip(), "user_id": cached_guid}
+        return cached_guid
     try:
-        return get_item_from_api_call(api_base, "api/authn/v2/users?deleted=false&user_name="+ request_encode(username.strip()), username.strip(), "users", "user_name", "user_id", True, verbose, False)
+        user_guid = get_item_from_api_call(api_base, "api/authn/v2/users?deleted=false&user_name="+ request_encode(username.strip()), username.strip(), "users", "user_name", "user_id", True, verbose, False)
     except (NoResultFoundException, NoExactMatchFoundException):
         print(f"Active user {username} not found, looking for inactive users")
-        return get_item_from_api_call(api_base, "api/authn/v2/users?deleted=false&inactive=true&user_name="+ request_encode(username.strip()), username.strip(), "users", "user_name", "user_id", True, verbose, False)
-    
+        user_guid = get_item_from_api_call(api_base, "api/authn/v2/users?deleted=false&inactive=true&user_name="+ request_encode(username.strip()), username.strip(), "users", "user_name", "user_id", True, verbose, False)
+    if user_guid:
+        index_user({"user_name": username.strip(), "user_id": user_guid})
+    return user_guid
+
+
+
+def is_blank(field_value):
+    return field_value is None or field_value == ""
 
+def is_service_account(user):
+    # any value marks an API service account, such as x or 1, except false, which rows read as False
+    return bool(user.is_service_account)
 
-def add_field_if_not_blank_or_none(current_content, field_name, field_value, is_boolean=False):
-    if not field_value:
-        return current_content
-    if field_value == NONE:
-        field_value = ''
-    if field_name:
-        return current_content + f''',
-            "{field_name}": {'' if is_boolean else '"'}{field_value}{'' if is_boolean else '"'}'''
+def add_field_if_not_blank_or_none(request_body, field_name, field_value):
+    if is_blank(field_value):
+        return
+    request_body[field_name] = "" if field_value == NONE else str(field_value)
+
+def add_boolean_field_if_not_blank(request_body, field_name, field_value):
+    if is_blank(field_value) or field_value == NONE:
+        return
+    if isinstance(field_value, bool):
+        request_body[field_name] = field_value
+    elif str(field_value).strip().lower() in ("true", "false"):
+        request_body[field_name] = str(field_value).strip().lower() == "true"
     else:
-        return current_content + f''',
-            {field_value}'''
+        raise InvalidFieldValueException(f"Invalid value for {field_name} of user {request_body['user_name']}: '{field_value}', expected true or false")
 
-def list_allowed_ip_addresses(allowed_ip_addresses):
-    if not allowed_ip_addresses:
-        return ""
+def add_allowed_ip_addresses(request_body, allowed_ip_addresses):
+    if is_blank(allowed_ip_addresses):
+        return
     if allowed_ip_addresses == NONE:
-        return '"ip_restricted": false, "allowed_ip_addresses": []'
-    all_ip_addresses = allowed_ip_addresses.split(",")
-    inner_ip_addresses_list = ""
-    for ip_address in all_ip_addresses:
-        inner_ip_addresses_list = inner_ip_addresses_list + (""",
-            """ if inner_ip_addresses_list else "") + f'"{ip_address.strip()}"'
-    if inner_ip_addresses_list:
-        return f'''
-            "ip_restricted": true, "allowed_ip_addresses": [
-                {inner_ip_addresses_list}
-            ]'''
+        request_body["ip_restricted"] = False
+        request_body["allowed_ip_addresses"] = []
     else:
-        #this should, realistically, never happen
-        return None
+        request_body["ip_restricted"] = True
+        request_body["allowed_ip_addresses"] = [ip_address.strip() for ip_address in str(allowed_ip_addresses).split(",") if ip_address.strip()]
 
-def add_permission_based_on_teams(content):
-    return content + ''',"permissions":[
-      {
-         "permission_name":"apiUser"
-      }
-   ]'''
+def build_user_payload(api_base, user, is_new_user, verbose):
+    """Builds the body of the user POST/PUT request from a parsed row.
+    Blank fields are left out, NONE clears a field"""
+    request_body = {"user_name": str(user.username)}
+    if is_new_user and is_service_account(user):
+        request_body["permissions"] = [{"permission_name": "apiUser"}]
+    add_boolean_field_if_not_blank(request_body, "active", user.is_active)
+    add_field_if_not_blank_or_none(request_body, "first_name", user.first_name)
+    add_field_if_not_blank_or_none(request_body, "last_name", user.last_name)
+    add_field_if_not_blank_or_none(request_body, "email_address", user.email)
+    add_field_if_not_blank_or_none(request_body, "phone", user.phone)
+    add_field_if_not_blank_or_none(request_body, "title", user.position)
+    add_allowed_ip_addresses(request_body, user.restrict_login_ips)
+    add_boolean_field_if_not_blank(request_body, "login_enabled", user.is_login_enabled)
+    add_field_if_not_blank_or_none(request_body, "custom_one", user.custom_1)
+    add_field_if_not_blank_or_none(request_body, "custom_two", user.custom_2)
+    add_field_if_not_blank_or_none(request_body, "custom_three", user.custom_3)
+    add_field_if_not_blank_or_none(request_body, "custom_four", user.custom_4)
+    add_field_if_not_blank_or_none(request_body, "custom_five", user.custom_5)
+    if not is_blank(user.roles):
+        request_body["roles"] = get_role_list(user.roles)
+    if not is_blank(user.teams) or not is_blank(user.teams_managed):
+        with metrics.timed_phase("teams"):
+            team_list = get_team_list(api_base, user.teams, user.teams_managed, verbose)
+        if team_list or user.teams == NONE:
+            request_body["teams"] = team_list
+    return request_body
+
+def get_current_user(api_base, username, user_guid, verbose):
+    """Returns the full record of an existing user, from the user index when it holds one"""
+    indexed_user = user_index.get(username.strip().lower())
+    if indexed_user and "roles" in indexed_user and "teams" in indexed_user:
+        return indexed_user
+    path = f"{api_base}api/authn/v2/users/{user_guid}?detailed=true"
+    if verbose:
+        print(f"Calling: {path}")
+    response = api_request("GET", path, verbose)
+    body = get_response_body(response)
+    if response.status_code != 200:
+        error_message = f"ERROR: trying to get current state of user {username}: {response.status_code} - {body}"
+        print(error_message)
+        raise NoResultFoundException(error_message)
+    index_user(body)
+    return body
+
+def is_same_value(requested_value, current_value):
+    if isinstance(requested_value, str) and not isinstance(current_value, bool):
+        return requested_value == ("" if current_value is None else str(current_value))
+    return requested_value == current_value
+
+def get_changed_fields(request_body, current_user):
+    """Returns the part of request_body that differs from current_user, or None if nothing would change"""
+    changed_fields = {}
+    for field_name, requested_value in request_body.items():
+        if field_name == "user_name":
+            continue
+        current_value = current_user.get(field_name)
+        if field_name == "roles":
+            is_same = ({role["role_name"].lower() for role in requested_value} ==
+                       {role["role_name"].lower() for role in current_value or []})
+        elif field_name == "teams":
+            is_same = ({(team["team_id"], team["relationship"]["name"]) for team in requested_value} ==
+                       {(team["team_id"], team["relationship"]["name"]) for team in current_value or []})
+        elif field_name == "allowed_ip_addresses":
+            is_same = set(requested_value) == set(current_value or [])
+        else:
+            is_same = is_same_value(requested_value, current_value)
+        if not is_same:
+            changed_fields[field_name] = requested_value
+    if not changed_fields:
+        return None
+    if "ip_restricted" in changed_fields or "allowed_ip_addresses" in changed_fields:
+        changed_fields["ip_restricted"] = request_body["ip_restricted"]
+        changed_fields["allowed_ip_addresses"] = request_body["allowed_ip_addresses"]
+    changed_fields["user_name"] = request_body["user_name"]
+    return changed_fields
 
-def modify_user(api_base, user, can_create, generate_credentials, verbose):
+def modify_user(api_base, user, can_create, generate_credentials, skip_unchanged, verbose, is_retry=False):
     #TODO: add support for creating SAML accounts
-    if not user or not user["username"]:
+    if not user or not user.username:
         error_message = "Empty username field found"
         print(error_message)
         return error_message, "", ""
 
-    username = user["username"]
-    user_guid = get_user_guid(api_base, username, verbose)
+    username = user.username
+    unknown_roles = get_unknown_roles(user.roles)
+    if unknown_roles:
+        error_message = f"Unknown roles for user {username}: {', '.join(unknown_roles)}"
+        print(error_message)
+        return error_message, "", ""
+
+    with metrics.timed_phase("lookup"):
+        user_guid = get_user_guid(api_base, username, verbose)
 
     if not user_guid and not can_create:
         error_message = f"User with name '{username}' not found"
@@ -342,55 +1149,59 @@ def modify_user(api_base, user, can_create, generate_credentials, verbose):
         print(user)
     
     if is_new_user:
-        url_ending = f"?generate_api_creds={"true" if generate_credentials and user["is_service_account"] else "false"}"
+        url_ending = f"?generate_api_creds={"true" if generate_credentials and is_service_account(user) else "false"}"
     else:
         url_ending = f"/{user_guid}?partial=true&incremental=false"
 
 
     path = f"{api_base}api/authn/v2/users{url_ending}"
 
-    content = f'''"user_name": "{user["username"]}"'''
-    if is_new_user and user["is_service_account"]:
-        content = add_permission_based_on_teams(content)
-    content = add_field_if_not_blank_or_none(content, "active", user["is_active"], True)
-    content = add_field_if_not_blank_or_none(content, "first_name", user["first_name"])
-    content = add_field_if_not_blank_or_none(content, "last_name", user["last_name"])
-    content = add_field_if_not_blank_or_none(content, "email_address", user["email"])
-    content = add_field_if_not_blank_or_none(content, "phone", user["phone"])
-    content = add_field_if_not_blank_or_none(content, "title", user["position"])
-    content = add_field_if_not_blank_or_none(content, None, list_allowed_ip_addresses(user["restrict_login_ips"]))
-    content = add_field_if_not_blank_or_none(content, "login_enabled", None if user["is_login_enabled"] == None else str(user["is_login_enabled"]).lower(), True)
-    content = add_field_if_not_blank_or_none(content, "custom_one", user["custom_1"])
-    content = add_field_if_not_blank_or_none(content, "custom_two", user["custom_2"])
-    content = add_field_if_not_blank_or_none(content, "custom_three", user["custom_3"])
-    content = add_field_if_not_blank_or_none(content, "custom_four", user["custom_4"])
-    content = add_field_if_not_blank_or_none(content, "custom_five", user["custom_5"])
-    content = add_field_if_not_blank_or_none(content, None, list_roles(user["roles"]))
-    content = add_field_if_not_blank_or_none(content, None, list_teams(api_base, user["teams"], user["teams_managed"], verbose))
-
-    request_content=f'''{{
-            {content}
-        }}'''
+    request_body = build_user_payload(api_base, user, is_new_user, verbose)
+    if skip_unchanged and not is_new_user:
+        with metrics.timed_phase("lookup"):
+            try:
+                current_user = get_current_user(api_base, username, user_guid, verbose)
+            except NoResultFoundException:
+                if is_retry or not invalidate_cached_ids(user):
+                    raise
+                print(f"Cached ids for {username} are no longer valid, looking them up again")
+                return modify_user(api_base, user, can_create, generate_credentials, skip_unchanged, verbose, True)
+        request_body = get_changed_fields(request_body, current_user)
+        if not request_body:
+            print(f"User {username} is already up to date.")
+            return STATUS_UNCHANGED, "", ""
     if verbose:
         print(f"Sending {"POST" if is_new_user else "PUT"} request to: {path}")
         print("Request Content:")
-        print(request_content)
+        print(json.dumps(request_body, indent=4))
 
-    if is_new_user:
-        response = requests.post(path, auth=RequestsAuthPluginVeracodeHMAC(), headers=json_headers, json=json.loads(request_content), verify=verify_ssl)
-    else:
-        response = requests.put(path, auth=RequestsAuthPluginVeracodeHMAC(), headers=json_headers, json=json.loads(request_content), verify=verify_ssl)
+    with metrics.timed_phase("write"):
+        if is_new_user:
+            response = api_request("POST", path, verbose, request_body)
+        else:
+            response = api_request("PUT", path, verbose, request_body)
 
+    body = get_response_body(response)
     if verbose:
         print(f"status code {response.status_code}")
-        body = response.json()
         if body:
             print(body)
+    # a deleted user gives a 404, a deleted team a 400
+    if response.status_code in (400, 404) and not is_retry and invalidate_cached_ids(user):
+        print(f"Cached ids for {username} are no longer valid, looking them up again")
+        return modify_user(api_base, user, can_create, generate_credentials, skip_unchanged, verbose, True)
     if response.status_code == 200 or response.status_code == 201:
         if is_new_user:
             print(f"Successfully created {username}.")
+            if "user_id" in body:
+                index_user(body)
         else:
             print(f"Successfully modified user permissions for {username}.")
+            if skip_unchanged and isinstance(body, dict) and "user_id" in body:
+                index_user(body)
+            elif username.strip().lower() in user_index:
+                # the teams of the indexed user may have changed, they are read again when needed
+                user_index[username.strip().lower()].pop("teams", None)
         if generate_credentials and "api_credentials" in body:
             api_credentials = body["api_credentials"]
             api_id = api_credentials["api_id"]
@@ -400,7 +1211,6 @@ def modify_user(api_base, user, can_create, generate_credentials, verbose):
             api_secret = ""
         return STATUS_SUCCESS, api_id, api_secret
     else:
-        body = response.json()
         if (body):
             error_message = f"Operation failed for user {username}: {response.status_code} - {body}"
         else:
@@ -408,80 +1218,850 @@ def modify_user(api_base, user, can_create, generate_credentials, verbose):
         print(error_message)
         return error_message, "", ""
     
-def parse_user(excel_sheet, row):
-    user = {}
-    user["is_service_account"] = excel_sheet.cell(row = row, column = API_SERVICE_ACCOUNT_COLUMN).value
-    user["is_active"] = excel_sheet.cell(row = row, column = ACTIVE_COLUMN).value
-    user["username"] = excel_sheet.cell(row = row, column = USERNAME_COLUMN).value
-    user["first_name"] = excel_sheet.cell(row = row, column = FIRST_NAME_COLUMN).value
-    user["last_name"] = excel_sheet.cell(row = row, column = LAST_NAME_COLUMN).value
-    user["email"] = excel_sheet.cell(row = row, column = EMAIL_COLUMN).value
-    user["phone"] = excel_sheet.cell(row = row, column = PHONE_COLUMN).value
-    user["position"] = excel_sheet.cell(row = row, column = POSITION_COLUMN).value
-    user["restrict_login_ips"] = excel_sheet.cell(row = row, column = RESTRICT_LOGIN_IPS_COLUMN).value
-    user["is_login_enabled"] = excel_sheet.cell(row = row, column = LOGIN_ENABLED_COLUMN).value
-    user["custom_1"] = excel_sheet.cell(row = row, column = CUSTOM_1_COLUMN).value
-    user["custom_2"] = excel_sheet.cell(row = row, column = CUSTOM_2_COLUMN).value
-    user["custom_3"] = excel_sheet.cell(row = row, column = CUSTOM_3_COLUMN).value
-    user["custom_4"] = excel_sheet.cell(row = row, column = CUSTOM_4_COLUMN).value
-    user["custom_5"] = excel_sheet.cell(row = row, column = CUSTOM_5_COLUMN).value
-    user["teams"] = excel_sheet.cell(row = row, column = TEAMS_COLUMN).value
-    user["roles"] = excel_sheet.cell(row = row, column = ROLES_COLUMN).value
-    user["teams_managed"] = excel_sheet.cell(row = row, column = TEAMS_MANAGED_COLUMN).value
-
-    return user
-    
+def parse_field_value(field_name, value):
+    """Turns the text true or false of a true/false field into a boolean, leaving any other value to be checked.
+    Numbers and dates in any other field, such as a team named 2024, are turned into text"""
+    if field_name in BOOLEAN_FIELDS:
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().lower() == "true"
+        return value
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+def parse_user(values):
+    return UserRow(*(parse_field_value(field_name, values[column-1]) for field_name, column in USER_COLUMNS.items()))
+
+def get_results_name(file_name):
+    base_name, extension = os.path.splitext(file_name)
+    return f"{base_name}{RESULTS_SUFFIX}{extension}"
+
+def is_csv_file(file_name):
+    return file_name.lower().endswith(".csv")
+
+def is_jsonl_file(file_name):
+    return file_name.lower().endswith(".jsonl")
+
+def is_text_file(file_name):
+    return is_csv_file(file_name) or is_jsonl_file(file_name)
+
+def get_field_name(header):
+    """Maps a CSV header or JSON key, such as 'First Name*' or 'first_name', to a UserRow field or 'status'"""
+    field_name = re.sub(r"[^a-z0-9]+", "_", str(header).lower()).strip("_")
+    field_name = HEADER_ALIASES.get(field_name, field_name)
+    return field_name if field_name in USER_COLUMNS or field_name == "status" else None
+
+def parse_text_value(field_name, value):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    return parse_field_value(field_name, value)
+
+def parse_user_fields(fields):
+    user = UserRow(*(parse_text_value(field_name, fields.get(field_name)) for field_name in USER_COLUMNS))
+    return user, fields.get("status") or None
+
+def read_csv_user_rows(file_name):
+    """Streams (line, user, status) for every line of a CSV file.
+    The first line is used as header when it names any of the columns, otherwise columns follow the Excel template"""
+    with open(file_name, newline="", encoding="utf-8-sig") as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        field_names = [get_field_name(name) for name in header] if header else []
+        if not any(field_names):
+            field_names = [None] * LAST_COLUMN
+            for field_name, column in USER_COLUMNS.items():
+                field_names[column-1] = field_name
+            field_names.append("status")
+            if header:
+                yield (1, *parse_user_fields(dict(zip(field_names, header))))
+        for values in reader:
+            if any(value.strip() for value in values):
+                yield (reader.line_num, *parse_user_fields(dict(zip(field_names, values))))
+
+def get_jsonl_value(value):
+    # a list, such as "teams": ["Team A", "Team B"], is read like the comma separated cells of the template
+    return ", ".join(str(item) for item in value) if isinstance(value, list) else value
+
+def read_jsonl_user_rows(file_name):
+    """Streams (line, user, status) for every JSON object in a JSON Lines file, keyed by header or field names.
+    Lines that are not a JSON object are streamed as an UnreadableUserRow"""
+    with open(file_name, encoding="utf-8") as jsonl_file:
+        for line_number, line in enumerate(jsonl_file, 1):
+            if not line.strip():
+                continue
+            try:
+                values = json.loads(line)
+            except ValueError as e:
+                yield line_number, UnreadableUserRow(*([None] * len(UserRow._fields)), f"invalid JSON on line {line_number}: {e}"), None
+                continue
+            if not isinstance(values, dict):
+                yield line_number, UnreadableUserRow(*([None] * len(UserRow._fields)), f"line {line_number} is not a JSON object"), None
+                continue
+            fields = {get_field_name(key): get_jsonl_value(value) for key, value in values.items()}
+            yield (line_number, *parse_user_fields(fields))
+
+def read_user_rows(file_name, sheet_name=None):
+    if is_csv_file(file_name):
+        return read_csv_user_rows(file_name)
+    if is_jsonl_file(file_name):
+        return read_jsonl_user_rows(file_name)
+    return read_excel_user_rows(file_name, sheet_name)
+
+def read_timed_user_rows(file_name, sheet_name=None):
+    """Same as read_user_rows, recording the time spent reading and parsing each row"""
+    user_rows = read_user_rows(file_name, sheet_name)
+    while True:
+        start_time = time.perf_counter()
+        user_row = next(user_rows, None)
+        if user_row is None:
+            return
+        metrics.record_phase("parse", time.perf_counter() - start_time)
+        yield user_row
+
+def get_sheet(excel_file, sheet_name):
+    return excel_file[sheet_name] if sheet_name else excel_file.active
+
+def read_excel_user_rows(file_name, sheet_name=None):
+    """Streams (row, user, status) for every line of a sheet, the active one by default, without loading the workbook in memory"""
+    excel_file = openpyxl.load_workbook(file_name, read_only=True)
+    try:
+        excel_sheet = get_sheet(excel_file, sheet_name)
+        for row, values in enumerate(excel_sheet.iter_rows(min_row=FIRST_ROW, max_col=STATUS_COLUMN, values_only=True), FIRST_ROW):
+            if len(values) < STATUS_COLUMN:
+                values = values + (None,) * (STATUS_COLUMN - len(values))
+            yield row, parse_user(values), values[STATUS_COLUMN-1]
+    finally:
+        excel_file.close()
+
+def get_sheet_names(file_name):
+    excel_file = openpyxl.load_workbook(file_name, read_only=True)
+    try:
+        return excel_file.sheetnames
+    finally:
+        excel_file.close()
+
+def is_output_file(file_name):
+    base_name, extension = os.path.splitext(file_name)
+    return base_name.endswith(RESULTS_SUFFIX) or extension in (JOURNAL_SUFFIX, ".tmp")
+
+def get_input_sources(file_patterns, all_sheets):
+    """Expands file names and glob patterns into (file_name, sheet_name) pairs to process in order.
+    sheet_name is None for the active sheet and for CSV and JSON Lines files"""
+    sources = []
+    for file_pattern in file_patterns:
+        file_names = sorted(file_name for file_name in glob.glob(file_pattern) if not is_output_file(file_name)) or [file_pattern]
+        for file_name in file_names:
+            if all_sheets and not is_text_file(file_name):
+                new_sources = [(file_name, sheet_name) for sheet_name in get_sheet_names(file_name)]
+            else:
+                new_sources = [(file_name, None)]
+            sources.extend(source for source in new_sources if source not in sources)
+    return sources
+
+def process_row(api_base, user, row, index, total_rows, previous_row_for_user, journal, can_create, generate_credentials, skip_unchanged, verbose, merged_rows=None):
+    if previous_row_for_user:
+        # rows for the same username are applied in sheet order
+        try:
+            previous_row_for_user.result()
+        except Exception:
+            pass
+    thread_state.profile = choose_profile() if len(api_profiles) > 1 else None
+    try:
+        print(f"Importing row {index}/{total_rows} (physical row: {row}):")
+        status, api_id, api_secret = modify_user(api_base, 
+                                     user,
+                                     can_create, 
+                                     generate_credentials,
+                                     skip_unchanged,
+                                     verbose)
+        print(f"Finished importing row {index}/{total_rows} (physical row: {row})")
+        print("---------------------------------------------------------------------------")
+    except (NoExactMatchFoundException, UnableToCreateTeamException, NoResultFoundException, InvalidFieldValueException) as e:
+        status= e.get_message()
+        api_id = ""
+        api_secret = ""
+    except requests.RequestException as e:
+        # a call that failed after its retries only fails its row, the other rows are still processed
+        status = f"Operation failed for user {user.username}: {e}"
+        print(status)
+        api_id = ""
+        api_secret = ""
+    with metrics.timed_phase("journal"):
+        for merged_row, merged_user in merged_rows or [(row, user)]:
+            metrics.record_row(status if status in COMPLETED_STATUSES else ROW_OUTCOME_FAILED)
+            journal.append(merged_row, merged_user.username, (status, api_id, api_secret))
+    return status, api_id, api_secret
+
+def get_merge_key(field_name, value):
+    if field_name in ("teams", "teams_managed"):
+        return team_key(value)
+    if field_name == "roles":
+        return role_key(value)
+    return value.strip()
+
+def merge_list_values(field_name, values):
+    """Combines the comma separated values of a field from several rows, a NONE discards the values before it"""
+    merged_values = None
+    for value in values:
+        if is_blank(value):
+            continue
+        if value == NONE:
+            merged_values = NONE
+            continue
+        if merged_values is None or merged_values == NONE:
+            merged_values = {}
+        for item in str(value).split(","):
+            if item.strip():
+                merged_values.setdefault(get_merge_key(field_name, item), item.strip())
+    if merged_values is None or merged_values == NONE:
+        return merged_values
+    return ", ".join(merged_values.values())
+
+def merge_user_rows(users):
+    """Merges rows of the same user in sheet order: teams, roles and IP addresses are combined,
+    the last non-blank value of any other field wins"""
+    merged_fields = {}
+    for field_name in UserRow._fields:
+        values = [getattr(user, field_name) for user in users]
+        if field_name in MERGED_LIST_FIELDS:
+            merged_fields[field_name] = merge_list_values(field_name, values)
+        else:
+            merged_fields[field_name] = next((value for value in reversed(values) if not is_blank(value)), None)
+    merged_fields["username"] = users[0].username
+    return UserRow(**merged_fields)
+
+def is_team_only_row(user):
+    # like build_user_payload, teams are only changed when NONE or when they name at least one team
+    return ((user.teams == NONE or split_team_names(user.teams) or split_team_names(user.teams_managed))
+            and all(is_blank(getattr(user, field_name)) for field_name in UserRow._fields if field_name not in TEAM_BATCH_FIELDS))
 
-def modify_all_users(api_base, file_name, can_create, generate_credentials, verbose):
-    global failed_attempts
+def get_team_members(api_base, team_id, verbose):
+    """Returns the current members of a team as (user_name, relationship), keyed by normalized username"""
+    path = f"{api_base}api/authn/v2/teams/{team_id}"
+    if verbose:
+        print(f"Calling: {path}")
+    response = api_request("GET", path, verbose)
+    body = get_response_body(response)
+    if response.status_code != 200:
+        raise NoResultFoundException(f"ERROR: trying to get members of team {team_id}: {response.status_code} - {body}")
+    if not isinstance(body, dict) or not isinstance(body.get("users"), list):
+        # sending the members back would remove everyone left out of the response
+        raise NoResultFoundException(f"ERROR: the members of team {team_id} were not returned, no members were removed")
+    return {member["user_name"].strip().lower(): (member["user_name"], (member.get("relationship") or {}).get("name", TEAM_MEMBER_RELATIONSHIP))
+            for member in body["users"]}
+
+def put_team_members(api_base, team_id, members, is_incremental, verbose):
+    """Sends (user_name, relationship) members of a team, adding to the current members when is_incremental,
+    replacing them otherwise. Returns an error message if it failed"""
+    path = f"{api_base}api/authn/v2/teams/{team_id}?partial=true&incremental={'true' if is_incremental else 'false'}"
+    request_body = {"users": [{"user_name": user_name, "relationship": {"name": relationship}} for user_name, relationship in members]}
+    if verbose:
+        print(f"Sending PUT request to: {path}")
+        print(json.dumps(request_body, indent=4))
+    try:
+        response = api_request("PUT", path, verbose, request_body)
+    except requests.RequestException as e:
+        error_message = f"Unable to update team {team_id}: {e}"
+        print(error_message)
+        return error_message
+    if response.status_code == 200:
+        return None
+    error_message = f"Unable to update team {team_id}: {response.status_code} - {get_response_body(response)}"
+    print(error_message)
+    return error_message
+
+def update_team_members(api_base, team_id, membership_changes, verbose):
+    """Adds and updates members of a team with an incremental request that only names them.
+    Members are removed by reading the current members and sending back the remaining ones.
+    Returns the error message of every user whose change failed, keyed by normalized username"""
+    added_members = {username_key: member for username_key, member in membership_changes.items() if member[1]}
+    removed_members = [username_key for username_key in membership_changes if username_key not in added_members]
+    errors = {}
+    if added_members:
+        error_message = put_team_members(api_base, team_id, added_members.values(), True, verbose)
+        if error_message:
+            errors.update(dict.fromkeys(added_members, error_message))
+    if removed_members:
+        try:
+            members = get_team_members(api_base, team_id, verbose)
+        except NoResultFoundException as e:
+            print(e.get_message())
+            members = None
+            errors.update(dict.fromkeys(removed_members, e.get_message()))
+        except requests.RequestException as e:
+            error_message = f"ERROR: trying to get members of team {team_id}: {e}"
+            print(error_message)
+            members = None
+            errors.update(dict.fromkeys(removed_members, error_message))
+        if members is not None:
+            for username_key in removed_members:
+                members.pop(username_key, None)
+            error_message = put_team_members(api_base, team_id, members.values(), False, verbose)
+            if error_message:
+                errors.update(dict.fromkeys(removed_members, error_message))
+    if not errors:
+        print(f"Successfully updated {len(membership_changes)} members of team {team_id}.")
+    return errors
+
+def apply_team_batch(api_base, team_batch_rows, merge_duplicates, verbose):
+    """Applies rows that only set teams with one request per changed team instead of one per user.
+    Returns the result of every row"""
+    row_results = {}
+    desired_teams = {}
+    membership_changes = {}
+    for username_key, rows in team_batch_rows.items():
+        users = [user for row, user in rows]
+        # like separate PUTs with incremental=false, the last row of a user wins unless rows are merged
+        user = merge_user_rows(users) if merge_duplicates else users[-1]
+        current_user = user_index[username_key]
+        try:
+            user_teams = {} if user.teams == NONE else {
+                team["team_id"]: team["relationship"]
+                for team in get_all_teams_json(api_base, split_team_names(user.teams), split_team_names(user.teams_managed), verbose).values()}
+            if "teams" not in current_user:
+                # written earlier in the run, its teams are read again
+                current_user = get_current_user(api_base, current_user["user_name"], current_user["user_id"], verbose)
+        except (NoExactMatchFoundException, UnableToCreateTeamException, NoResultFoundException) as e:
+            for row, user in rows:
+                row_results[row] = (e.get_message(), "", "")
+            continue
+        except requests.RequestException as e:
+            for row, user in rows:
+                row_results[row] = (f"Operation failed for user {user.username}: {e}", "", "")
+            continue
+        if not user_teams and user.teams != NONE:
+            # a PUT of the user leaves its teams alone in this case, so the rows are sent that way
+            continue
+        desired_teams[username_key] = user_teams
+        # an indexed user always has its teams here, only the detailed record of a user without teams may leave them out
+        current_teams = {team["team_id"]: team["relationship"]["name"] for team in current_user.get("teams") or []}
+        for team_id in set(current_teams) | set(desired_teams[username_key]):
+            if current_teams.get(team_id) != desired_teams[username_key].get(team_id):
+                membership_changes.setdefault(team_id, {})[username_key] = (current_user["user_name"], desired_teams[username_key].get(team_id))
+    print(f"Updating {len(membership_changes)} teams for {len(desired_teams)} users whose rows only set teams")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        team_errors = dict(zip(membership_changes, executor.map(
+            lambda team_id: update_team_members(api_base, team_id, membership_changes[team_id], verbose), membership_changes)))
+    for username_key, teams in desired_teams.items():
+        changed_teams = [team_id for team_id, changes in membership_changes.items() if username_key in changes]
+        errors = [team_errors[team_id][username_key] for team_id in changed_teams if username_key in team_errors[team_id]]
+        if errors and any([invalidate_cached_ids(user) for row, user in team_batch_rows[username_key]]):
+            # sent again on its own with the ids looked up again, reading the user's current teams first
+            user_index[username_key].pop("teams", None)
+            continue
+        if errors:
+            status = f"Operation failed for user {user_index[username_key]['user_name']}: {'; '.join(errors)}"
+        elif changed_teams:
+            status = STATUS_SUCCESS
+            user_index[username_key]["teams"] = [{"team_id": team_id, "relationship": {"name": relationship}} for team_id, relationship in teams.items()]
+        else:
+            status = STATUS_UNCHANGED
+        for row, user in team_batch_rows[username_key]:
+            row_results[row] = (status, "", "")
+    return row_results
+
+def get_invalid_ip_addresses(allowed_ip_addresses):
+    invalid_ip_addresses = []
+    # like add_allowed_ip_addresses, blank entries are left out
+    for ip_address in [ip_address.strip() for ip_address in str(allowed_ip_addresses).split(",") if ip_address.strip()]:
+        try:
+            ipaddress.ip_network(ip_address, strict=False)
+        except ValueError:
+            invalid_ip_addresses.append(ip_address)
+    return invalid_ip_addresses
+
+def get_validation_errors(user):
+    """Returns what is wrong with a row without calling the API, empty if it can be sent"""
+    if isinstance(user, UnreadableUserRow):
+        return [user.error]
+    if is_blank(user.username) or not str(user.username).strip():
+        return ["Empty username field found"]
+    errors = []
+    if not is_blank(user.email) and user.email != NONE and not EMAIL_PATTERN.fullmatch(str(user.email).strip()):
+        errors.append(f"invalid email '{user.email}'")
+    if not is_blank(user.restrict_login_ips) and user.restrict_login_ips != NONE:
+        invalid_ip_addresses = get_invalid_ip_addresses(user.restrict_login_ips)
+        if invalid_ip_addresses:
+            errors.append(f"invalid IP addresses or ranges: {', '.join(invalid_ip_addresses)}")
+    for field_name in CHECKED_BOOLEAN_FIELDS:
+        value = getattr(user, field_name)
+        if not is_blank(value) and value != NONE and not isinstance(value, bool) and str(value).strip().lower() not in ("true", "false"):
+            errors.append(f"{field_name} must be true or false, not '{value}'")
+    unknown_roles = get_unknown_roles(user.roles)
+    if unknown_roles:
+        errors.append(f"unknown roles: {', '.join(unknown_roles)}")
+    return errors
+
+def scan_user_rows(user_rows, merge_duplicates, team_batch):
+    """Reads every row once before anything is sent, checking and collecting what the rows still to be processed need.
+    Invalid rows and rows that repeat the previous row of the same user are left out of the teams, merged rows
+    and team batch rows. Only the row numbers of rows to merge are kept, so memory does not grow with the rows"""
+    row_count = 0
+    row_errors = {}
+    duplicate_of = {}
+    team_names = {}
+    # the row number and hash of the last row of every user, to find rows that repeat it
+    last_row_for_user = {}
+    duplicate_row_numbers = {}
+    team_batch_rows = {}
+    other_usernames = set()
+    for row, user, status in user_rows:
+        row_count += 1
+        if status in COMPLETED_STATUSES:
+            continue
+        errors = get_validation_errors(user)
+        if errors:
+            row_errors[row] = f"Invalid row for user {user.username}: {'; '.join(errors)}" if user.username else errors[0]
+            continue
+        username_key = str(user.username).strip().lower()
+        user_hash = hash(user)
+        previous_row, previous_hash = last_row_for_user.get(username_key, (None, None))
+        if previous_hash == user_hash:
+            duplicate_of[row] = previous_row
+            continue
+        for teams in (user.teams, user.teams_managed):
+            for team_name in split_team_names(teams):
+                team_names.setdefault(team_key(team_name), team_name)
+        if merge_duplicates and username_key in duplicate_row_numbers:
+            duplicate_row_numbers[username_key].append(row)
+        elif merge_duplicates and previous_row is not None:
+            # the user's only row so far
+            duplicate_row_numbers[username_key] = [previous_row, row]
+        if team_batch and username_key not in other_usernames:
+            if is_team_only_row(user) and username_key in user_index:
+                team_batch_rows.setdefault(username_key, []).append((row, user))
+            else:
+                other_usernames.add(username_key)
+                team_batch_rows.pop(username_key, None)
+        last_row_for_user[username_key] = (row, user_hash)
+    return RowScan(row_count, row_errors, duplicate_of, team_names, duplicate_row_numbers, team_batch_rows)
+
+def get_duplicate_rows(user_rows, duplicate_row_numbers):
+    """Reads the (row, user) of the rows to merge, keyed by normalized username, stopping after the last of them"""
+    usernames_by_row = {row: username_key for username_key, rows in duplicate_row_numbers.items() for row in rows}
+    duplicate_rows = {username_key: [] for username_key in duplicate_row_numbers}
+    for row, user, status in user_rows:
+        if row in usernames_by_row:
+            duplicate_rows[usernames_by_row.pop(row)].append((row, user))
+            if not usernames_by_row:
+                break
+    return duplicate_rows
+
+def get_journal_name(file_name, sheet_name=None):
+    if sheet_name:
+        return f"{file_name}.{re.sub(r'[^A-Za-z0-9_-]+', '_', sheet_name)}{JOURNAL_SUFFIX}"
+    return f"{file_name}{JOURNAL_SUFFIX}"
+
+def ends_with_newline(file_name):
+    """Returns whether a file is empty or ends with a complete line"""
+    with open(file_name, "rb") as text_file:
+        if text_file.seek(0, os.SEEK_END) == 0:
+            return True
+        text_file.seek(-1, os.SEEK_END)
+        return text_file.read(1) == b"\n"
+
+def read_journal(journal_name):
+    """Returns the last recorded result of every row in a progress journal"""
+    entries = {}
+    if not os.path.exists(journal_name):
+        return entries
+    with open(journal_name, encoding="utf-8") as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if the run was killed while writing it
+                continue
+            entries[entry["row"]] = entry
+    return entries
+
+def read_text_results(results_name):
+    """Returns the result of every row in the results file of an earlier run on a CSV or JSON Lines file"""
+    entries = {}
+    if not os.path.exists(results_name):
+        return entries
+    with open(results_name, newline="", encoding="utf-8") as results_file:
+        if is_csv_file(results_name):
+            lines = csv.DictReader(results_file)
+        else:
+            lines = (json.loads(line) for line in results_file if line.strip())
+        for line in lines:
+            entry = {field_name: line.get(field_name) or "" for field_name in RESULT_FIELDS}
+            entry["row"] = int(entry["row"])
+            entries[entry["row"]] = entry
+    return entries
+
+def apply_journal(user_rows, journal_entries):
+    """Replaces the status of rows already recorded in the journal, as long as the row still has the same username"""
+    for row, user, status in user_rows:
+        entry = journal_entries.get(row)
+        if entry and entry["username"] == user.username:
+            status = entry["status"]
+        yield row, user, status
+
+def write_results(file_name, results, sheet_name=None):
+    """Writes the status and API credentials of every processed row into a sheet of the workbook, the active one by default"""
+    if not results:
+        return
     excel_file = openpyxl.load_workbook(file_name)
-    excel_sheet = excel_file.active    
+    excel_sheet = get_sheet(excel_file, sheet_name)
+    for row, (status, api_id, api_secret) in results.items():
+        excel_sheet.cell(row = row, column = STATUS_COLUMN).value=status
+        excel_sheet.cell(row = row, column = API_ID_COLUMN).value=api_id
+        excel_sheet.cell(row = row, column = API_SECRET_COLUMN).value=api_secret
+    excel_file.save(filename=file_name)
+
+def copy_cell_with_style(target_sheet, cell):
+    if not getattr(cell, "has_style", False):
+        return cell.value
+    new_cell = WriteOnlyCell(target_sheet, value=cell.value)
+    new_cell.font = copy(cell.font)
+    new_cell.fill = copy(cell.fill)
+    new_cell.border = copy(cell.border)
+    new_cell.alignment = copy(cell.alignment)
+    new_cell.number_format = cell.number_format
+    return new_cell
+
+def write_results_streaming(file_name, results, sheet_name=None):
+    """Writes the status and API credentials of every processed row of a sheet, the active one by default,
+    by streaming a copy of the workbook. Values are kept for every sheet, but only the header rows keep their formatting"""
+    if not results:
+        return
+    source_file = openpyxl.load_workbook(file_name, read_only=True)
+    target_file = openpyxl.Workbook(write_only=True)
     try:
-        for row in range(FIRST_ROW, excel_sheet.max_row+1):
-            failed_attempts = 0
-            status=excel_sheet.cell(row = row, column = STATUS_COLUMN).value
-            if (status == STATUS_SUCCESS):
-                print(f"Skipping row {row-FIRST_ROW+1} as it was already done (physical row: {row})")
+        results_title = get_sheet(source_file, sheet_name).title
+        for source_sheet in source_file.worksheets:
+            target_sheet = target_file.create_sheet(source_sheet.title)
+            for row, cells in enumerate(source_sheet.iter_rows(), 1):
+                if row < FIRST_ROW:
+                    values = [copy_cell_with_style(target_sheet, cell) for cell in cells]
+                else:
+                    values = [cell.value for cell in cells]
+                if source_sheet.title == results_title and row in results:
+                    values = values[:STATUS_COLUMN-1] + [None] * (STATUS_COLUMN-1-len(values)) + list(results[row]) + values[API_SECRET_COLUMN:]
+                target_sheet.append(values)
+    finally:
+        source_file.close()
+    temporary_file_name = f"{file_name}.tmp"
+    target_file.save(temporary_file_name)
+    os.replace(temporary_file_name, file_name)
+
+def modify_all_users(api_base, file_name, can_create, generate_credentials, prefetch_users, skip_unchanged, streaming, resume, merge_duplicates, team_batch, verbose, sheet_name=None):
+    journal_name = get_journal_name(file_name, sheet_name)
+    journal_entries = {}
+    if os.path.exists(journal_name):
+        if not resume:
+            print(f"Found progress journal {journal_name} from an interrupted run, use the -r flag to resume it")
+            return False
+        journal_entries = read_journal(journal_name)
+        print(f"Resuming from {journal_name}: {len(journal_entries)} rows already processed")
+    results_name = get_results_name(file_name) if is_text_file(file_name) else None
+    previous_results = read_text_results(results_name) if results_name else {}
+    if previous_results:
+        print(f"Found the results of {len(previous_results)} rows in {results_name}, rows already done are skipped")
+        # the journal of an interrupted run is more recent than the results
+        journal_entries = {**previous_results, **journal_entries}
+    if (prefetch_users or team_batch) and not user_index_loaded:
+        # team updates are computed from the current teams of every user
+        load_user_directory(api_base, skip_unchanged or team_batch, verbose)
+    if role_catalog is None:
+        load_role_catalog(api_base, verbose)
+    results = {}
+    result_writer = TextResultWriter(results_name, previous_results) if results_name else None
+    pending_rows = deque()
+    last_row_for_user = {}
+    merged_futures = {}
+    journal = ProgressJournal(journal_name)
+    is_complete = False
+
+    def save_result(row, user, result):
+        with metrics.timed_phase("save"):
+            if result_writer:
+                result_writer.write(row, user.username, result)
             else:
-                try:
-                    print(f"Importing row {row-FIRST_ROW+1}/{excel_sheet.max_row-FIRST_ROW+1} (physical row: {row}):")
-                    status, api_id, api_secret = modify_user(api_base, 
-                                                 parse_user(excel_sheet, row),
-                                                 can_create, 
-                                                 generate_credentials,
-                                                 verbose)
-                    print(f"Finished importing row {row-FIRST_ROW+1}/{excel_sheet.max_row-FIRST_ROW+1} (physical row: {row})")
-                    print("---------------------------------------------------------------------------")
-                except (NoExactMatchFoundException, UnableToCreateTeamException, NoResultFoundException) as e:
-                    status= e.get_message()
-                    api_id = ""
-                    api_secret = ""
-                excel_sheet.cell(row = row, column = STATUS_COLUMN).value=status
-                excel_sheet.cell(row = row, column = API_ID_COLUMN).value=api_id
-                excel_sheet.cell(row = row, column = API_SECRET_COLUMN).value=api_secret
+                results[row] = result
+
+    def save_next_pending_row():
+        finished_row, finished_user, finished_username_key, finished_future = pending_rows.popleft()
+        result = finished_future.result()
+        if finished_row in duplicate_of:
+            # not processed on its own, so only counted and recorded once its result is known
+            metrics.record_row(result[0] if result[0] in COMPLETED_STATUSES else ROW_OUTCOME_FAILED)
+            journal.append(finished_row, finished_user.username, result)
+        save_result(finished_row, finished_user, result)
+        if last_row_for_user.get(finished_username_key) is finished_future:
+            del last_row_for_user[finished_username_key]
+
+    try:
+        row_scan = scan_user_rows(apply_journal(read_user_rows(file_name, sheet_name), journal_entries), merge_duplicates, team_batch)
+        total_rows = row_scan.row_count
+        row_errors = row_scan.row_errors
+        duplicate_of = row_scan.duplicate_of
+        if row_errors or duplicate_of:
+            print(f"Found {len(row_errors)} invalid rows and {len(duplicate_of)} repeated rows before sending anything")
+        duplicated_rows = set(duplicate_of.values())
+        row_futures = {}
+        prepare_teams(api_base, row_scan.team_names, verbose)
+        duplicate_rows = {}
+        if row_scan.duplicate_row_numbers:
+            duplicate_rows = get_duplicate_rows(read_user_rows(file_name, sheet_name), row_scan.duplicate_row_numbers)
+        if duplicate_rows:
+            print(f"Merging {sum(len(rows) for rows in duplicate_rows.values())} rows of {len(duplicate_rows)} users found on several rows")
+        team_batch_results = {}
+        if row_scan.team_batch_rows:
+            team_batch_results = apply_team_batch(api_base, row_scan.team_batch_rows, merge_duplicates, verbose)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for index, (row, user, status) in enumerate(apply_journal(read_timed_user_rows(file_name, sheet_name), journal_entries), 1):
+                if (status in COMPLETED_STATUSES):
+                    print(f"Skipping row {index} as it was already done (physical row: {row})")
+                    metrics.record_row(ROW_OUTCOME_SKIPPED)
+                    if row in journal_entries:
+                        entry = journal_entries[row]
+                        save_result(row, user, (entry["status"], entry["api_id"], entry["api_secret"]))
+                    elif result_writer:
+                        save_result(row, user, (status, "", ""))
+                    continue
+                username_key = str(user.username or "").strip().lower()
+                if row in row_errors:
+                    print(row_errors[row])
+                    result = (row_errors[row], "", "")
+                    metrics.record_row(ROW_OUTCOME_FAILED)
+                    journal.append(row, user.username, result)
+                    future = Future()
+                    future.set_result(result)
+                elif row in duplicate_of:
+                    # same values as the previous row of the user, which gives its result to both
+                    future = row_futures[duplicate_of[row]]
+                elif row in team_batch_results:
+                    result = team_batch_results.pop(row)
+                    metrics.record_row(result[0] if result[0] in COMPLETED_STATUSES else ROW_OUTCOME_FAILED)
+                    journal.append(row, user.username, result)
+                    future = Future()
+                    future.set_result(result)
+                elif username_key in merged_futures:
+                    # already sent with the first row of the user
+                    future = merged_futures[username_key]
+                elif username_key in duplicate_rows:
+                    merged_rows = duplicate_rows[username_key]
+                    print(f"Merging physical rows {', '.join(str(merged_row) for merged_row, merged_user in merged_rows)} for user {user.username}")
+                    future = executor.submit(process_row, api_base, merge_user_rows([merged_user for merged_row, merged_user in merged_rows]),
+                                             row, index, total_rows, None, journal, can_create, generate_credentials, skip_unchanged, verbose,
+                                             merged_rows)
+                    merged_futures[username_key] = future
+                else:
+                    future = executor.submit(process_row, api_base, user, row, index, total_rows, last_row_for_user.get(username_key), journal,
+                                             can_create, generate_credentials, skip_unchanged, verbose)
+                    last_row_for_user[username_key] = future
+                if row in duplicated_rows:
+                    row_futures[row] = future
+                pending_rows.append((row, user, username_key, future))
+                # results are saved in row order, keeping at most a few rows per worker in flight
+                while len(pending_rows) > workers * 4 or (pending_rows and pending_rows[0][3].done()):
+                    save_next_pending_row()
+            while pending_rows:
+                save_next_pending_row()
+        is_complete = True
     finally:
-        excel_file.save(filename=file_name)
+        journal.close()
+        if result_writer:
+            result_writer.close()
+        elif streaming:
+            write_results_streaming(file_name, results, sheet_name)
+        else:
+            write_results(file_name, results, sheet_name)
+        print_profile_usage()
+    if is_complete and os.path.exists(journal_name):
+        # every result is now in the output file
+        os.remove(journal_name)
+    return is_complete
+
+def get_source_name(file_name, sheet_name):
+    return f"{file_name} [{sheet_name}]" if sheet_name else file_name
+
+def get_self_username(api_base, verbose):
+    path = f"{api_base}api/authn/v2/users/self"
+    if verbose:
+        print(f"Calling: {path}")
+    response = api_request("GET", path, verbose)
+    body = get_response_body(response)
+    if response.status_code != 200:
+        error_message = f"ERROR: trying to get the current API user: {response.status_code} - {body}"
+        print(error_message)
+        raise NoResultFoundException(error_message)
+    return body["user_name"]
+
+def get_sync_usernames(sources):
+    """Returns the usernames on the rows of the (file_name, sheet_name) sources, and the rows that cannot be read or have
+    no username as (source_name, row, error). Rows without any value are left out"""
+    usernames = set()
+    unidentified_rows = []
+    for file_name, sheet_name in sources:
+        for row, user, status in read_user_rows(file_name, sheet_name):
+            if isinstance(user, UnreadableUserRow) or is_blank(user.username) or not str(user.username).strip():
+                if any(not is_blank(value) for value in user):
+                    unidentified_rows.append((get_source_name(file_name, sheet_name), row, get_validation_errors(user)[0]))
+            else:
+                usernames.add(str(user.username).strip().lower())
+    return usernames, unidentified_rows
+
+def get_users_to_deactivate(api_base, usernames_to_keep, verbose):
+    """Returns the active users of the user directory that are not in usernames_to_keep, leaving out the caller"""
+    usernames_to_keep = usernames_to_keep | {get_self_username(api_base, verbose).strip().lower()}
+    return [user for username_key, user in user_index.items() if username_key not in usernames_to_keep and user.get("active") is True]
+
+def deactivate_user(api_base, username, verbose):
+    thread_state.profile = choose_profile() if len(api_profiles) > 1 else None
+    user = UserRow(*([None] * len(UserRow._fields)))._replace(username=username, is_active=False)
+    try:
+        status, api_id, api_secret = modify_user(api_base, user, False, False, False, verbose)
+    except (NoExactMatchFoundException, UnableToCreateTeamException, NoResultFoundException) as e:
+        status = e.get_message()
+    except requests.RequestException as e:
+        status = f"Operation failed for user {username}: {e}"
+    return status
+
+def sync_users(api_base, sources, dry_run, threshold_percent, verbose):
+    """Deactivates every active user of the organization that is not in any of the (file_name, sheet_name) sources"""
+    if not user_index_loaded:
+        load_user_directory(api_base, False, verbose)
+    active_count = sum(1 for user in user_index.values() if user.get("active") is True)
+    usernames_to_keep, unidentified_rows = get_sync_usernames(sources)
+    users_to_deactivate = sorted(user["user_name"] for user in get_users_to_deactivate(api_base, usernames_to_keep, verbose))
+    print(f"{len(users_to_deactivate)} of {active_count} active users are not in {', '.join(get_source_name(*source) for source in sources)}")
+    for source_name, row, error in unidentified_rows:
+        print(f"Row {row} of {source_name} does not name a user: {error}")
+    if dry_run:
+        for username in users_to_deactivate:
+            print(f"Would deactivate user: {username}")
+    if unidentified_rows:
+        # the user of such a row could be deactivated although it is in the file
+        print(f"ERROR: {len(unidentified_rows)} rows could not be read or have no username, "
+              f"no user {'would be' if dry_run else 'is'} deactivated")
+        return
+    if dry_run:
+        return
+    if len(users_to_deactivate) > active_count * threshold_percent / 100:
+        print(f"ERROR: not deactivating {len(users_to_deactivate)} users, as it is more than {threshold_percent}% of the active users. "
+              "Use --sync_threshold to allow it")
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(executor.map(lambda username: deactivate_user(api_base, username, verbose), users_to_deactivate))
+    failures = [(username, status) for username, status in zip(users_to_deactivate, statuses) if status != STATUS_SUCCESS]
+    for username, status in failures:
+        print(f"ERROR: unable to deactivate {username}: {status}")
+    print(f"Deactivated {len(users_to_deactivate)-len(failures)} users, {len(failures)} failed")
+
+def copy_template_header(target_sheet):
+    """Appends the header rows of the Excel template, with their formatting, to a write-only sheet.
+    Falls back to the field names when the template is not next to the script"""
+    template_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), TEMPLATE_FILE_NAME)
+    if not os.path.exists(template_name):
+        for row in range(1, FIRST_ROW-1):
+            target_sheet.append([])
+        target_sheet.append(list(USER_COLUMNS) + ["status", "api_id", "api_secret"])
+        return
+    template_file = openpyxl.load_workbook(template_name)
+    try:
+        template_sheet = template_file.active
+        for column_letter, column_dimension in template_sheet.column_dimensions.items():
+            target_sheet.column_dimensions[column_letter].width = column_dimension.width
+        for cells in template_sheet.iter_rows(min_row=1, max_row=FIRST_ROW-1):
+            target_sheet.append([copy_cell_with_style(target_sheet, cell) for cell in cells])
+    finally:
+        template_file.close()
+
+def get_export_values(user, team_names):
+    """Returns the cells of a user in the *_COLUMN layout, naming its teams from the team index"""
+    values = [None] * LAST_COLUMN
+    teams = [(team_names.get(team["team_id"]) or team.get("team_name"), team.get("relationship", {}).get("name"))
+             for team in user.get("teams") or []]
+    values[API_SERVICE_ACCOUNT_COLUMN-1] = any(permission.get("permission_name") == API_USER_PERMISSION
+                                               for permission in user.get("permissions") or [])
+    values[ACTIVE_COLUMN-1] = user.get("active")
+    values[USERNAME_COLUMN-1] = user.get("user_name")
+    values[FIRST_NAME_COLUMN-1] = user.get("first_name")
+    values[LAST_NAME_COLUMN-1] = user.get("last_name")
+    values[EMAIL_COLUMN-1] = user.get("email_address")
+    values[PHONE_COLUMN-1] = user.get("phone")
+    values[POSITION_COLUMN-1] = user.get("title")
+    if user.get("ip_restricted") and user.get("allowed_ip_addresses"):
+        values[RESTRICT_LOGIN_IPS_COLUMN-1] = ", ".join(user["allowed_ip_addresses"])
+    values[LOGIN_ENABLED_COLUMN-1] = user.get("login_enabled")
+    values[CUSTOM_1_COLUMN-1] = user.get("custom_one")
+    values[CUSTOM_2_COLUMN-1] = user.get("custom_two")
+    values[CUSTOM_3_COLUMN-1] = user.get("custom_three")
+    values[CUSTOM_4_COLUMN-1] = user.get("custom_four")
+    values[CUSTOM_5_COLUMN-1] = user.get("custom_five")
+    values[TEAMS_COLUMN-1] = ", ".join(team_name for team_name, relationship in teams if team_name) or None
+    values[ROLES_COLUMN-1] = ", ".join(role["role_name"] for role in user.get("roles") or []) or None
+    values[TEAMS_MANAGED_COLUMN-1] = ", ".join(team_name for team_name, relationship in teams
+                                               if team_name and relationship == TEAM_ADMIN_RELATIONSHIP) or None
+    return values
+
+def export_all_users(api_base, file_name, verbose):
+    """Writes every active and inactive user of the organization to a workbook in the layout of the Excel template,
+    streaming each page of users to the file as it arrives"""
+    print("Loading team index")
+    team_names = {team["team_id"]: team["team_name"]
+                  for team in get_all_items_from_api_call(api_base, "api/authn/v2/teams?all_for_org=true", "teams", verbose)}
+    print(f"Loaded {len(team_names)} teams")
+    excel_file = openpyxl.Workbook(write_only=True)
+    excel_sheet = excel_file.create_sheet()
+    copy_template_header(excel_sheet)
+    user_count = 0
+    for api_to_call in ["api/authn/v2/users?deleted=false&detailed=true", "api/authn/v2/users?deleted=false&inactive=true&detailed=true"]:
+        for users in iterate_pages_from_api_call(api_base, api_to_call, "users", verbose):
+            for user in users:
+                excel_sheet.append(get_export_values(user, team_names))
+            user_count += len(users)
+            print(f"Exported {user_count} users")
+    temporary_file_name = f"{file_name}.tmp"
+    excel_file.save(temporary_file_name)
+    os.replace(temporary_file_name, file_name)
+    print(f"Exported {user_count} users to {file_name}")
+
+def get_api_key_id():
+    return api_profiles[0].api_key_id or get_credentials()[0]
+
+def get_region(api_key_id):
+    return "eu" if api_key_id.startswith("vera01") else "com"
 
 def get_api_base():
-    api_key_id, api_key_secret = get_credentials()
     api_base = "https://api.veracode.{instance}/"
-    if api_key_id.startswith("vera01"):
-        return api_base.replace("{instance}", "eu", 1)
-    else:
-        return api_base.replace("{instance}", "com", 1)
+    return api_base.replace("{instance}", get_region(get_api_key_id()), 1)
 
 def main(argv):
     """Allows for bulk creation or modifying user and permissions"""
-    global failed_attempts
     global verify_ssl
+    global workers
+    global pool_size
+    global max_attempts_per_request
+    global connect_timeout
+    global read_timeout
     excel_file = None
+    report_name = None
+    cache_name = None
+    export_name = None
     try:
         verbose = False
         can_create = False
         generate_credentials = False
+        prefetch_users = False
+        skip_unchanged = False
+        streaming = False
+        resume = False
+        merge_duplicates = False
+        team_batch = False
+        sync = False
+        dry_run = False
+        sync_threshold = DEFAULT_SYNC_THRESHOLD_PERCENT
+        all_sheets = False
         file_name = ''
+        file_patterns = []
+        cache_ttl = DEFAULT_CACHE_TTL
 
-        opts, args = getopt.getopt(argv, "hdcgf:v:", ["file_name=","verify_ssl="])
+        opts, args = getopt.getopt(argv, "hdcgpusrmtf:v:w:e:", ["file_name=","verify_ssl=","workers=","pool_size=","max_attempts=","connect_timeout=","read_timeout=","skip_unchanged","streaming","resume","merge_duplicates","team_batch","report=","cache=","cache_ttl=","profiles=","export=","sync","dry_run","sync_threshold=","all_sheets"])
         for opt, arg in opts:
             if opt == '-h':
                 print_help()
@@ -491,14 +2071,71 @@ def main(argv):
                 can_create = True
             if opt == '-g':
                 generate_credentials = True
+            if opt == '-p':
+                prefetch_users = True
+            if opt in ('-u', '--skip_unchanged'):
+                skip_unchanged = True
+            if opt in ('-s', '--streaming'):
+                streaming = True
+            if opt in ('-r', '--resume'):
+                resume = True
+            if opt in ('-m', '--merge_duplicates'):
+                merge_duplicates = True
+            if opt in ('-t', '--team_batch'):
+                team_batch = True
+            if opt == '--sync':
+                sync = True
+            if opt == '--dry_run':
+                dry_run = True
+            if opt == '--sync_threshold':
+                sync_threshold=float(arg)
             if opt in ('-v', '--verify_ssl'):
                 verify_ssl=arg.strip().lower() == "true"
             if opt in ('-f', '--file_name'):
-                file_name=arg
+                file_patterns.append(arg)
+            if opt == '--all_sheets':
+                all_sheets = True
+            if opt in ('-e', '--export'):
+                export_name=arg
+            if opt in ('-w', '--workers'):
+                workers=max(1, int(arg))
+            if opt == '--pool_size':
+                pool_size=max(1, int(arg))
+            if opt == '--max_attempts':
+                max_attempts_per_request=max(1, int(arg))
+            if opt == '--connect_timeout':
+                connect_timeout=float(arg)
+            if opt == '--read_timeout':
+                read_timeout=float(arg)
+            if opt == '--report':
+                report_name=arg
+            if opt == '--cache':
+                cache_name=arg
+            if opt == '--profiles':
+                load_api_profiles([profile_name.strip() for profile_name in arg.split(",") if profile_name.strip()])
+            if opt == '--cache_ttl':
+                cache_ttl=max(0, int(arg))
 
+        if dry_run and not sync:
+            print("ERROR: --dry_run can only be used with --sync")
+            sys.exit(1)
         api_base = get_api_base()
-        if file_name:
-            modify_all_users(api_base, file_name, can_create, generate_credentials, verbose)
+        if cache_name:
+            open_id_cache(cache_name, cache_ttl, api_base)
+        if export_name:
+            export_all_users(api_base, export_name, verbose)
+        elif file_patterns and sync and dry_run:
+            sync_users(api_base, get_input_sources(file_patterns, all_sheets), True, sync_threshold, verbose)
+        elif file_patterns:
+            sources = get_input_sources(file_patterns, all_sheets)
+            is_complete = True
+            for file_name, sheet_name in sources:
+                if len(sources) > 1:
+                    print(f"Processing {get_source_name(file_name, sheet_name)}")
+                is_complete = modify_all_users(api_base, file_name, can_create, generate_credentials, prefetch_users, skip_unchanged, streaming, resume,
+                                               merge_duplicates, team_batch, verbose, sheet_name) and is_complete
+            if sync and is_complete:
+                sync_users(api_base, sources, False, sync_threshold, verbose)
         else:
             print_help()
     except requests.RequestException as e:
@@ -508,6 +2145,9 @@ def main(argv):
     finally:
         if excel_file:
             excel_file.save(filename=file_name)
+        if report_name:
+            write_report(report_name)
+        close_id_cache()
 
 
 if __name__ == "__main__":